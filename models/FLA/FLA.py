@@ -1,31 +1,18 @@
 from datetime import timedelta
-import os
 import torch
 import time
 import torch.nn.functional as F
 from tqdm import tqdm
-import heapq
 import gc
-import gzip
 
 from script.test.model import Model
+from script.utils.password_index import load_test_index
 
 from models.FLA.architecture import LSTM
 from models.FLA.guesser import Guesser
 from models.FLA.fla_utils.dataloader import *
 
 
-def get_lower_probability_threshold(n_samples):
-    n_samples = int(n_samples)
-    if n_samples <= 10 ** 6:
-        return 0.00000001
-    elif n_samples <= 10 ** 7:
-        return 0.000000001
-    elif n_samples <= 5 * (10 ** 8):
-        return 0.0000000001
-    else:
-        return 0.00000000001
-
 class FLA(Model):
     def __init__(self, settings):
         self.model = None
@@ -34,6 +21,7 @@ class FLA(Model):
         super().__init__(settings)
 
     def prepare_data(self, train_passwords, test_passwords, max_length):
+        test_passwords = load_test_index(self.path_to_test_dataset)
         return DataLoader(train_passwords, test_passwords, max_length, self.params)
 
     def load(self, file_to_load):
@@ -107,17 +95,16 @@ class FLA(Model):
                 n_iter += 1
 
             if current_epoch % checkpoint_frequency == 0:
-                matches, _, _ = self.evaluate(n_samples=10 ** 6, validation_mode=True)
-                if matches >= n_matches:
-                    n_matches = matches
-                    obj = {
-                        'model': self.model.state_dict(),
-                        'optimizer': self.optimizer.state_dict(),
-                    }
-                    self.save(obj)
+                obj = {
+                    'model': self.model.state_dict(),
+                    'optimizer': self.optimizer.state_dict(),
+                }
+                n_matches = self.save_best(self.validate_checkpoint(obj), n_matches)
 
             current_epoch += 1
 
+        n_matches = self.save_best(self.finish_validation(), n_matches)
+
         end = time.time()
         time_delta = timedelta(seconds=end - start)
         print(f"[T] - Training completed after: {time_delta}")
@@ -125,37 +112,19 @@ class FLA(Model):
     def eval_init(self, n_samples, evaluation_batch_size):
         self.model.eval()
         eval_dict = {
-            'n_samples': n_samples,
-            'output_file': os.path.join(self.path_to_guesses_dir, "total_guesses.gz"),
+            'n_samples': int(n_samples),
         }
         return eval_dict
 
     def sample(self, evaluation_batch_size, eval_dict):
-        lower_probability_threshold = get_lower_probability_threshold(eval_dict['n_samples'])
-        guesser = Guesser(model=self.model, params=self.params, data=self.data,
-                          lower_probability_threshold=lower_probability_threshold, output_file=eval_dict['output_file'],
-                          device=self.device)
-        n_gen = guesser.complete_guessing()
-
-        print(f"[I] - Generated {n_gen} passwords")
-
-        min_heap_n_most_prob = []
-
-        with gzip.open(eval_dict['output_file'], "rt") as f_out:
-            for line in f_out:
-                line = line.split(" ")
-                if len(line) != 2:
-                    continue
-
-                password, prob = line[0].replace("~", ""), float(line[1])
-
-                if len(min_heap_n_most_prob) < eval_dict['n_samples']:
-                    heapq.heappush(min_heap_n_most_prob, (prob, password))
-                else:
-                    if prob > min_heap_n_most_prob[0][0]:
-                        heapq.heappushpop(min_heap_n_most_prob, (prob, password))
+        # The guesser enumerates the n_samples most probable passwords directly, in descending probability order.
+        # Duplicates left by stripping the padding are dropped, keeping that order.
+        guesser = Guesser(model=self.model, params=self.params, data=self.data, device=self.device)
+        passwords = (password.replace("~", "") for password, _ in guesser.guess(eval_dict['n_samples']))
+        n_most_prob_psw = list(dict.fromkeys(passwords))
 
-        n_most_prob_psw = {password for prob, password in heapq.nlargest(eval_dict['n_samples'], min_heap_n_most_prob)}
+        print(f"[I] - Generated {guesser.n_generated_passwords} passwords, "
+              f"covering a probability mass of {guesser.covered_probability:.6f}")
 
         return n_most_prob_psw
 
@@ -164,5 +133,4 @@ class FLA(Model):
 
     def post_sampling(self, eval_dict):
         gc.collect()
-        os.remove(eval_dict['output_file'])
         pass
\ No newline at end of file
@@ -1,9 +1,11 @@
+import torch
 from torch import nn
 
 class LSTM(nn.Module):
     def __init__(self, lstm_hidden_size, dense_hidden_size, vocab_size, context_len, train_backwards=True):
         super(LSTM, self).__init__()
         self.train_backwards = train_backwards
+        self.context_len = context_len
 
         self.lstm = nn.LSTM(input_size=vocab_size, hidden_size=lstm_hidden_size, num_layers=3, batch_first=True)
 
@@ -24,3 +26,52 @@ class LSTM(nn.Module):
         x = self.fc1(x)
         x = self.fc2(x)
         return x
+
+    def empty_context(self):
+        """
+        In the backward layout, a prefix of n characters is read by the LSTM after context_len - n empty positions,
+        which do not depend on the prefix. For every number m of empty positions, returns the LSTM state after them and
+        their contribution to fc1, so that forward_prefixes only runs the LSTM over the n characters of each prefix.
+        """
+        hidden_size = self.lstm.hidden_size
+        weight = self.fc1.weight
+        state = None
+        states, contributions = [None], [torch.zeros(weight.shape[0], device=weight.device)]
+        empty = torch.zeros(1, 1, self.lstm.input_size, device=weight.device)
+
+        for t in range(self.context_len):
+            output, state = self.lstm(empty, state)
+            # The output of step t is at position context_len - 1 - t once flipped back.
+            position = self.context_len - 1 - t
+            contribution = weight[:, position * hidden_size:(position + 1) * hidden_size] @ output[0, 0]
+            states.append(state)
+            contributions.append(contributions[-1] + contribution)
+
+        return states, contributions
+
+    def forward_prefixes(self, x, lengths, context):
+        """
+        Same as forward for the prefixes x (one-hot, empty positions after the prefix) of the given lengths, using
+        the empty_context of the model. Only available in the backward layout.
+        """
+        hidden_size = self.lstm.hidden_size
+        states, contributions = context
+        dense = torch.empty(len(x), self.fc1.out_features, device=x.device)
+
+        for length in torch.unique(lengths).tolist():
+            rows = torch.nonzero(lengths == length).flatten()
+            n_empty = self.context_len - length
+            inputs = x[rows, :length].flip(1)
+
+            if length > 0:
+                state = states[n_empty]
+                if state is not None:
+                    state = tuple(s.expand(-1, len(rows), -1).contiguous() for s in state)
+                output, _ = self.lstm(inputs, state)
+                output = self.flatten(output.flip(1))
+                dense[rows] = output @ self.fc1.weight[:, :length * hidden_size].T + contributions[n_empty]
+            else:
+                dense[rows] = contributions[n_empty]
+
+        dense += self.fc1.bias
+        return self.fc2(dense)
@@ -1,6 +1,7 @@
 import numpy as np
 
 from models.FLA.fla_utils.tokenizer import Tokenizer
+from script.utils.password_index import TextPasswordIndex
 
 class DataLoader():
     def __init__(self, train_passwords, test_passwords, max_length, params):
@@ -12,7 +13,7 @@ class DataLoader():
         self.tokenizer = Tokenizer(self.char_bag, self.max_length, self.PASSWORD_END, padding_character=False)
 
         self.train_passwords = train_passwords
-        self.test_passwords = set(test_passwords)
+        self.test_passwords = test_passwords
 
     def prepare_y_data(self, y_str_list):
         y_vec = np.zeros((len(y_str_list), self.tokenizer.vocab_size), dtype=np.bool_)
@@ -46,6 +47,13 @@ class DataLoader():
             x_vec, y_vec = self.prepare_data(batch)
             yield x_vec, y_vec
 
+    def hold_out(self, n_passwords):
+        # Removes the last n_passwords passwords from the training set and returns them as a TextPasswordIndex.
+        n_train = len(self.train_passwords) - n_passwords
+        held_out = TextPasswordIndex.from_passwords(self.train_passwords[n_train:])
+        self.train_passwords = self.train_passwords[:n_train]
+        return held_out
+
     def get_test_size(self):
         return len(self.test_passwords)
 
@@ -0,0 +1,80 @@
+import os
+import heapq
+import shutil
+import tempfile
+import numpy as np
+
+
+class Frontier():
+    """
+    Priority queue of (key, kind, codes) entries, popped in increasing key order, holding at most max_size entries in
+    memory. When it grows larger, the lower half of the in-memory heap is written to disk as a sorted run. Runs are read
+    back block by block, as soon as their next entry is smaller than the top of the in-memory heap.
+    """
+
+    def __init__(self, max_size, width, block_size=65536):
+        self.max_size = max(int(max_size), 2)
+        self.width = width
+        self.block_size = block_size
+        self.heap = []
+        self.runs = []
+        self.n_spilled = 0
+        self.n_runs = 0
+        self.path = None
+
+    def __len__(self):
+        return len(self.heap) + sum(len(run['keys']) - run['position'] for run in self.runs)
+
+    def push(self, entry):
+        heapq.heappush(self.heap, entry)
+        if len(self.heap) > self.max_size:
+            self._spill()
+
+    def pop(self):
+        self._refill()
+        return heapq.heappop(self.heap)
+
+    def close(self):
+        self.runs = []
+        self.heap = []
+        if self.path is not None:
+            shutil.rmtree(self.path, ignore_errors=True)
+            self.path = None
+
+    def _spill(self):
+        if self.path is None:
+            self.path = tempfile.mkdtemp(prefix='frontier_')
+
+        entries = sorted(self.heap)
+        keep = self.max_size // 2
+        self.heap = entries[:keep]
+        spilled = entries[keep:]
+
+        run_path = os.path.join(self.path, f'run_{self.n_runs}')
+        self.n_runs += 1
+        keys = np.array([entry[0] for entry in spilled], dtype=np.float64)
+        kinds = np.array([entry[1] for entry in spilled], dtype=np.uint8)
+        codes = np.array([entry[2] for entry in spilled], dtype=f'S{self.width}')
+        for name, array in (('keys', keys), ('kinds', kinds), ('codes', codes)):
+            np.save(f'{run_path}.{name}.npy', array)
+
+        self.runs.append({name: np.load(f'{run_path}.{name}.npy', mmap_mode='r') for name in ('keys', 'kinds', 'codes')})
+        self.runs[-1]['position'] = 0
+        self.n_spilled += len(spilled)
+
+    def _refill(self):
+        while True:
+            self.runs = [run for run in self.runs if run['position'] < len(run['keys'])]
+            if not self.runs:
+                return
+
+            run = min(self.runs, key=lambda run: run['keys'][run['position']])
+            if self.heap and self.heap[0][0] <= run['keys'][run['position']]:
+                return
+
+            start, end = run['position'], run['position'] + self.block_size
+            run['position'] = min(end, len(run['keys']))
+            block = zip(run['keys'][start:end].tolist(), run['kinds'][start:end].tolist(),
+                        run['codes'][start:end].tolist())
+            for entry in block:
+                heapq.heappush(self.heap, entry)
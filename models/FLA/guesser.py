@@ -2,23 +2,39 @@ import numpy
 import torch
 import numpy as np
 import torch.nn.functional as F
-import gzip
+from tqdm import tqdm
+
+from models.FLA.fla_utils.frontier import Frontier
 
 class Guesser():
-    def __init__(self, model, params, data, lower_probability_threshold, output_file, device):
+    # Prefixes are stored as rows of max_len uint8 codes, where code c + 1 is the character c of the tokenizer and 0 is
+    # the empty position after the end of the prefix. In the heap, a row is kept as a bytes object (trailing zeros
+    # removed), whose length is therefore the length of the prefix.
+    MIN_PASSWORD_LENGTH = 4
+
+    def __init__(self, model, params, data, device):
         self.model = model
         self.data = data
         self.max_len = self.data.max_length
         self.params = params
-        self.lower_probability_threshold = lower_probability_threshold
         self.chunk_size_guesser = self.params['eval']['chunk_size_guesser']
         self.n_generated_passwords = 0
-        self.generated_passwords = []
         self.PASSWORD_END = '\n'
         self.pwd_end_idx = self.data.tokenizer.char_indices[self.PASSWORD_END]
-        self.output_file = output_file
         self.device = device
 
+        vocab_size = self.data.tokenizer.vocab_size
+        # One-hot rows indexed by code, the code 0 is encoded as a row of zeros.
+        self.one_hot = np.eye(vocab_size + 1, dtype=np.float32)[:, 1:]
+        self.decoding_table = {i + 1: char for i, char in enumerate(self.data.tokenizer.char_list)}
+
+        # In the backward layout, the LSTM states of the empty positions are computed once and shared by all prefixes.
+        self.context = None
+        if self.model.train_backwards:
+            self.model.eval()
+            with torch.no_grad():
+                self.context = self.model.empty_context()
+
     def generate(self, x_data):
         self.model.eval()
         with torch.no_grad():
@@ -27,141 +43,144 @@ class Guesser():
             output = np.array(output.to("cpu"), dtype=numpy.float64)
         return output
 
-    def encode_passwords(self, astring_list):
-        max_len = self.max_len
-        x_data = []
+    def generate_prefixes(self, x_data, lengths):
+        with torch.no_grad():
+            output = self.model.forward_prefixes(x_data, torch.from_numpy(lengths).to(self.device), self.context)
+            output = F.softmax(output, dim=1)
+            output = np.array(output.to("cpu"), dtype=numpy.float64)
+        return output
+
+    def encode_prefixes(self, prefixes):
+        codes = np.array(prefixes, dtype=f'S{self.max_len}').view(np.uint8).reshape(len(prefixes), self.max_len)
+        lengths = np.count_nonzero(codes, axis=1)
+        return codes, lengths
 
-        for password in astring_list:
-            current_password = []
+    def decode_prefix(self, prefix):
+        return prefix.decode('latin-1').translate(self.decoding_table)
 
-            for char in password:
-                encoded_char = self.data.charmap[char]
-                current_password.append(encoded_char)
+    def relevel_predictions(self, preds, lengths):
+        # Passwords shorter than MIN_PASSWORD_LENGTH can not end, prefixes of max_len characters can only end.
+        too_short = lengths < self.MIN_PASSWORD_LENGTH
+        preds[too_short, self.pwd_end_idx] = 0
 
-            while len(current_password) < max_len:
-                current_password.append(0)
+        full = (lengths >= self.max_len) & ~too_short
+        preds[full] = 0
+        preds[full, self.pwd_end_idx] = 1
 
-            x_data.append(current_password)
+        preds /= preds.sum(axis=1, keepdims=True)
+        return preds
 
-        x_data = torch.tensor(np.array(x_data), dtype=torch.long).to(self.device)
-        x_data = F.one_hot(x_data, self.data.charmap_size).to(self.device).to(torch.float32)
-        return x_data
+    def conditional_probs_many(self, codes, lengths):
+        x_data = torch.from_numpy(self.one_hot[codes]).to(self.device)
 
-    def relevel_prediction(self, preds, astring):
-        if isinstance(astring, tuple):
-            astring_joined_len = sum(map(len, astring))
+        if self.context is not None:
+            answer = self.generate_prefixes(x_data, lengths)
         else:
-            astring_joined_len = 0
-        if not self.pwd_is_valid(astring):
-            preds[self.data.tokenizer.char_indices[self.PASSWORD_END]] = 0
-        elif len(astring) == self.max_len or (
-                isinstance(astring, tuple) and
-                astring_joined_len == self.max_len):
-            multiply = np.zeros(len(preds))
-            multiply[self.pwd_end_idx] = 1
-            preds[self.pwd_end_idx] = 1
-            preds = np.multiply(preds, multiply, preds)
-
-        sum_per = sum(preds)
-        for i, v in enumerate(preds):
-            preds[i] = v / sum_per
-
-    def pwd_is_valid(self, pwd):
-        if isinstance(pwd, tuple):
-            pwd = ''.join(pwd)
-        pwd = pwd.strip(self.PASSWORD_END)
-        answer = (all(map(lambda c: c in self.data.char_bag, pwd)) and
-                  len(pwd) <= self.max_len and
-                  len(pwd) >= 4)
-        return answer
-
-    def relevel_prediction_many(self, pred_list, str_list):
-        if (self.pwd_is_valid(str_list[0]) and len(str_list[0]) != self.max_len):
-            return
-        for i, pred_item in enumerate(pred_list):
-            self.relevel_prediction(pred_item[0], str_list[i])
-
-    def conditional_probs_many(self, astring_list):
-        x_data = self.data.tokenizer.encode_many(astring_list)
-        x_data = torch.tensor(np.array(x_data), dtype=torch.float32).to(self.device)
-
-        answer = self.generate(x_data)
-        if len(answer.shape) == 2:
-            answer = np.expand_dims(answer, axis=1)
-
-        assert answer.shape == (len(astring_list), 1, self.data.tokenizer.vocab_size)
-
-        self.relevel_prediction_many(answer, astring_list)
-        return answer
-
-    def next_nodes(self, astring, prob, prediction, file_buffer):
-        total_preds = prediction * prob
-        max_len = self.max_len
-        if len(astring) + 1 > max_len:
-            prob_end = total_preds[self.pwd_end_idx]
-            if prob_end >= self.lower_probability_threshold:
-                file_buffer.append(f"{astring} {prob_end}\n")
-                self.n_generated_passwords += 1
-            return []
-
-        indexes = np.arange(len(total_preds))
-        above_cutoff = total_preds >= self.lower_probability_threshold
-        above_indices = indexes[above_cutoff]
-        probs_above = total_preds[above_cutoff]
-        answer = []
-        for i, chain_prob in enumerate(probs_above):
-            char = self.data.tokenizer.char_list[above_indices[i]]
-            if char == self.PASSWORD_END:
-                file_buffer.append(f"{astring} {chain_prob}\n")
-                self.n_generated_passwords += 1
-            else:
-                chain_pass = astring + char
-                answer.append((chain_pass, chain_prob))
-        return answer
-
-    def batch_prob(self, prefixes):
-        return self.conditional_probs_many(prefixes)
-
-    def extract_pwd_from_node(self, node_list):
-        return map(lambda x: x[0], node_list)
-
-    def super_node_recur(self, node_list, file):
-        if len(node_list) == 0:
-            return
-        pwds_list = list(self.extract_pwd_from_node(node_list))
-        predictions = self.batch_prob(pwds_list)
-        node_batch = []
-        file_buffer = []
-        for i, cur_node in enumerate(node_list):
-            astring, prob = cur_node
-            for next_node in self.next_nodes(astring, prob, predictions[i][0], file_buffer):
-                node_batch.append(next_node)
-                if len(node_batch) == self.chunk_size_guesser:
-                    self.super_node_recur(node_batch, file)
-                    node_batch = []
-
-            if len(file_buffer) >= 1000000:
-                file.writelines(file_buffer)
-                file_buffer.clear()
-
-        if len(file_buffer) > 0:
-            file.writelines(file_buffer)
-            file_buffer.clear()
-
-        if len(node_batch) > 0:
-            self.super_node_recur(node_batch, file)
-            node_batch = []
-
-    def _recur(self, file, astring='', prob=1):
-        self.super_node_recur([(astring, prob)], file)
-
-    def starting_node(self, default_value):
-        return default_value
-
-    def guess(self, astring='', prob=1):
-        with gzip.open(self.output_file, 'at') as file:
-            self._recur(file, self.starting_node(astring), prob)
-
-    def complete_guessing(self, start='', start_prob=1):
-        self.guess(start, start_prob)
-        return self.n_generated_passwords
+            answer = self.generate(x_data)
+        assert answer.shape == (len(codes), self.data.tokenizer.vocab_size)
+
+        return self.relevel_predictions(answer, lengths)
+
+    def batch_prob(self, codes, lengths):
+        return self.conditional_probs_many(codes, lengths)
+
+    def next_nodes(self, codes, lengths, probs, predictions, cutoff):
+        """
+        Expands a batch of prefixes at once. Returns the probabilities of the batch prefixes as complete passwords, and
+        the codes and probabilities of the prefixes extending them with a probability of at least cutoff.
+        """
+        total_preds = predictions * probs[:, None]
+        end_probs = total_preds[:, self.pwd_end_idx].copy()
+
+        total_preds[:, self.pwd_end_idx] = 0
+        total_preds[lengths >= self.max_len] = 0
+        rows, chars = np.nonzero((total_preds >= cutoff) & (total_preds > 0))
+
+        child_codes = codes[rows]
+        child_codes[np.arange(len(rows)), lengths[rows]] = chars + 1
+        return end_probs, child_codes, total_preds[rows, chars]
+
+    @staticmethod
+    def keep_most_probable(best_probs, n_best, n_samples):
+        # Moves the n_samples largest of the first n_best probabilities to the front, the smallest of them first.
+        best_probs[:n_best].partition(n_best - n_samples)
+        best_probs[:n_samples] = best_probs[n_best - n_samples:n_best]
+        return best_probs[0]
+
+    def guess(self, n_samples, start='', start_prob=1.0):
+        """
+        Yields the n_samples most probable passwords as (password, probability), in descending probability order.
+
+        Prefixes are expanded best-first from a single frontier holding both prefixes and complete passwords, up to
+        chunk_size_guesser prefixes per network call. A password is yielded once it is on top of the frontier and no
+        expansion is pending, since the prefixes expanded later can only lead to less probable passwords. The frontier
+        keeps at most frontier_memory_size entries in memory and spills the others to disk.
+        """
+        start = bytes(self.data.tokenizer.char_indices[char] + 1 for char in start)
+        # Frontier entries: (-probability, 0 for a password or 1 for a prefix, prefix codes).
+        frontier = Frontier(self.params['eval'].get('frontier_memory_size', 10 ** 7), self.max_len)
+        frontier.push((-start_prob, 1, start))
+        # Probabilities of the passwords pushed so far, in a buffer pruned to the n_samples largest once full. The cutoff
+        # is the smallest of those n_samples: prefixes and passwords below it can never be part of the result and are
+        # not pushed.
+        best_probs = np.empty(n_samples + max(n_samples, self.chunk_size_guesser))
+        n_best = 0
+        cutoff = 0.0
+        self.n_generated_passwords = 0
+        self.covered_probability = 0.0
+
+        progress_bar = tqdm(total=n_samples, desc='Enumerating passwords')
+        try:
+            while len(frontier) and self.n_generated_passwords < n_samples:
+                batch, batch_probs, postponed = [], [], []
+                n_yielded = 0
+                while len(frontier) and len(batch) < self.chunk_size_guesser:
+                    entry = frontier.pop()
+                    if entry[1] == 1:
+                        batch.append(entry[2])
+                        batch_probs.append(-entry[0])
+                    elif not batch:
+                        yield self.decode_prefix(entry[2]), -entry[0]
+                        self.n_generated_passwords += 1
+                        self.covered_probability -= entry[0]
+                        n_yielded += 1
+                        if self.n_generated_passwords >= n_samples:
+                            break
+                    else:
+                        postponed.append(entry)
+
+                progress_bar.update(n_yielded)
+                progress_bar.set_postfix({'Probability mass': f'{self.covered_probability:.6f}',
+                                          'Frontier': len(frontier), 'Spilled': frontier.n_spilled})
+
+                for entry in postponed:
+                    frontier.push(entry)
+                if not batch or self.n_generated_passwords >= n_samples:
+                    continue
+
+                codes, lengths = self.encode_prefixes(batch)
+                predictions = self.batch_prob(codes, lengths)
+                end_probs, child_codes, child_probs = self.next_nodes(codes, lengths, np.array(batch_probs),
+                                                                      predictions, cutoff)
+
+                passwords = np.flatnonzero(end_probs > cutoff)
+                if n_best + len(passwords) > len(best_probs):
+                    cutoff = self.keep_most_probable(best_probs, n_best, n_samples)
+                    n_best = n_samples
+                    passwords = passwords[end_probs[passwords] > cutoff]
+                best_probs[n_best:n_best + len(passwords)] = end_probs[passwords]
+                n_best += len(passwords)
+                if cutoff == 0 and n_best >= n_samples:
+                    cutoff = self.keep_most_probable(best_probs, n_best, n_samples)
+                    n_best = n_samples
+
+                for i, prob in zip(passwords.tolist(), end_probs[passwords].tolist()):
+                    frontier.push((-prob, 0, batch[i]))
+
+                children = child_codes.view(f'S{self.max_len}').ravel().tolist()
+                for prefix, prob in zip(children, child_probs.tolist()):
+                    if prob >= cutoff:
+                        frontier.push((-prob, 1, prefix))
+        finally:
+            progress_bar.close()
+            frontier.close()
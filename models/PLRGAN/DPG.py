@@ -1,5 +1,4 @@
 import numpy as np
-from numpy_ringbuffer import RingBuffer
 import torch
 
 class DPG:
@@ -20,30 +19,80 @@ class DPG:
         self.matched_i = 0
 
         self.test_passwords = test_passwords
+        self.guessed = np.zeros(len(test_passwords), dtype=bool)
 
         if not self.STATIC:
-            self.guessed_z = RingBuffer(capacity=self.memory_bank_size, dtype=(np.float32, self.z_size))
+            # Latents of the matched passwords, kept on the device as a ring: once it is full, the oldest ones are
+            # overwritten. There can not be more of them than test passwords or generated passwords.
+            capacity = max(1, min(self.memory_bank_size, len(test_passwords), n_samples))
+            self.guessed_z = torch.empty((capacity, self.z_size), dtype=torch.float32, device=self.device)
+            self.n_guessed_z = 0
+            self.head = 0
 
-    def __call__(self, z, x):
+    def __call__(self, z, positions):
+        """
+        Updates the state with a batch of latents z (batch, z_size) and the positions of the passwords they generated
+        in the test set (-1 for the passwords that are not in it).
+        """
         if not self.init_att_size:
             self.init_att_size = len(self.test_passwords)
 
-        # ASSUMPTION: test set composed of unique passwords
-        if x in self.test_passwords:
-            self.matched_i += 1
-            self.test_passwords.remove(x)
-            if not self.STATIC:
-                self.guessed_z.append(z.cpu())
+        positions = np.asarray(positions)
+        hits = np.flatnonzero(positions >= 0)
+        hits = hits[~self.guessed[positions[hits]]]
+        # A password generated several times in the batch is matched by its first occurrence.
+        _, first = np.unique(positions[hits], return_index=True)
+        hits = np.sort(hits[first])
+        if len(hits) == 0:
+            return
 
-            if not self.STATIC and self.matched_i / self.init_att_size > self.hot_start and not self.DYNAMIC:
+        self.matched_i += len(hits)
+        self.guessed[positions[hits]] = True
+        if not self.STATIC:
+            self._append(z[torch.from_numpy(hits).to(z.device)])
+
+            if self.matched_i / self.init_att_size > self.hot_start and not self.DYNAMIC:
                 print("DYNAMIC starts now ....")
                 self.DYNAMIC = True
 
+    def _append(self, z):
+        capacity = len(self.guessed_z)
+        z = z[-capacity:].to(self.device, torch.float32)
+        slots = (self.head + torch.arange(len(z), device=self.device)) % capacity
+        self.guessed_z[slots] = z
+        self.head = (self.head + len(z)) % capacity
+        self.n_guessed_z = min(self.n_guessed_z + len(z), capacity)
+
+    def state_dict(self):
+        state = {
+            'DYNAMIC': self.DYNAMIC,
+            'init_att_size': self.init_att_size,
+            'matched_i': self.matched_i,
+            'guessed': np.flatnonzero(self.guessed),
+        }
+        if not self.STATIC:
+            # Oldest latent first.
+            capacity = len(self.guessed_z)
+            slots = (self.head - self.n_guessed_z + torch.arange(self.n_guessed_z, device=self.device)) % capacity
+            state['guessed_z'] = self.guessed_z[slots].cpu().numpy()
+        return state
+
+    def load_state_dict(self, state):
+        self.DYNAMIC = state['DYNAMIC']
+        self.init_att_size = state['init_att_size']
+        self.matched_i = state['matched_i']
+        self.guessed[:] = False
+        self.guessed[state['guessed']] = True
+        if not self.STATIC:
+            self.n_guessed_z = 0
+            self.head = 0
+            if len(state['guessed_z']):
+                self._append(torch.from_numpy(state['guessed_z']))
+
     def guess(self):
-        if self.DYNAMIC and len(self.guessed_z):
-            idxs = np.random.randint(0, len(self.guessed_z), self.batch_size, np.int32)
-            gi = self.guessed_z[idxs]
-            z = torch.normal(torch.FloatTensor(gi).to(self.device), self.stddv)
+        if self.DYNAMIC and self.n_guessed_z:
+            idxs = torch.randint(0, self.n_guessed_z, (self.batch_size,), device=self.device)
+            z = torch.normal(self.guessed_z[idxs], self.stddv)
         else:
             z = torch.normal(0, self.stddv_p, size=(self.batch_size, self.z_size))
         return z
@@ -9,8 +9,11 @@ from script.test.model import Model
 from script.dataset.dataset import Dataset
 from models.PLRGAN.architecture import Generator, Discriminator
 from models.PLRGAN.DPG import *
+from script.utils.parallel_sampler import ParallelSampler
 
 class PLRGAN(Model):
+    encoded_samples = True
+
     def __init__(self, settings):
         self.Generator = None
         self.generator_opt = None
@@ -20,7 +23,7 @@ class PLRGAN(Model):
         super().__init__(settings)
 
     def prepare_data(self, path_to_train_dataset, path_to_test_dataset, max_length):
-        return Dataset(path_to_train_dataset, path_to_test_dataset, max_length, self.test_hash)
+        return Dataset(path_to_train_dataset, path_to_test_dataset, max_length, self.train_hash, self.test_hash)
 
     def load(self, file_to_load):
         try:
@@ -101,6 +104,7 @@ class PLRGAN(Model):
         n_matches = 0
 
         checkpoint_frequency = self.params['eval']['checkpoint_frequency']
+        prefetch_batches = int(self.params['train'].get('prefetch_batches', 0))
 
         self.init_model()
 
@@ -108,8 +112,8 @@ class PLRGAN(Model):
 
             print(f"Epoch: {current_epoch + 1} / {epochs}")
 
-            for real_data in self.data.get_batches(batch_size=batch_size):
-                real_data = torch.tensor(real_data).to(self.device)
+            for real_data in self.data.get_batches(batch_size=batch_size, prefetch=prefetch_batches):
+                real_data = torch.as_tensor(real_data).to(self.device, non_blocking=True)
 
                 _ = self.train_discriminator(real_data)
                 disc_iteration_counter += 1
@@ -119,17 +123,13 @@ class PLRGAN(Model):
                     gen_iteration_counter += 1
 
                     if gen_iteration_counter % checkpoint_frequency == 0:
-                        matches, _, _ = self.evaluate(n_samples=10**6, validation_mode=True)
-                        if matches >= n_matches:
-                            n_matches = matches
-
-                            obj = {
-                                'generator_opt': self.generator_opt.state_dict(),
-                                'discriminator_opt': self.discriminator_opt.state_dict(),
-                                'Generator': self.Generator.state_dict(),
-                                'Discriminator': self.Discriminator.state_dict(),
-                            }
-                            self.save(obj)
+                        obj = {
+                            'generator_opt': self.generator_opt.state_dict(),
+                            'discriminator_opt': self.discriminator_opt.state_dict(),
+                            'Generator': self.Generator.state_dict(),
+                            'Discriminator': self.Discriminator.state_dict(),
+                        }
+                        n_matches = self.save_best(self.validate_checkpoint(obj), n_matches)
 
                     progress_bar.update(1)
 
@@ -138,6 +138,8 @@ class PLRGAN(Model):
 
             current_epoch += 1
 
+        n_matches = self.save_best(self.finish_validation(), n_matches)
+
         end = time.time()
         time_delta = timedelta(seconds=end - start)
         print(f"[T] - Training completed after: {time_delta}")
@@ -196,13 +198,22 @@ class PLRGAN(Model):
                 self.params['eval']['alpha'],
                 n_samples,
                 evaluation_batch_size,
-                self.data.test_passwords.copy(),
-                device=self.device)
+                self.data.test_passwords,
+                device=self.device),
+            'sampler': None,
         }
 
+        # Dynamic sampling depends on the matches of the previous batches, so it always runs in this process.
+        n_workers = int(self.params['eval'].get('sampling_workers', 0))
+        if n_workers > 0 and self.device.type == 'cpu' and not ds and not self.validating:
+            print(f"[I] - Sampling with {n_workers} worker processes.")
+            eval_dict['sampler'] = ParallelSampler(lambda: self.generate(evaluation_batch_size, eval_dict), n_workers,
+                                                   (evaluation_batch_size, self.data.max_length),
+                                                   seed=int(self.params['eval'].get('sampling_seed', 0)))
+
         return eval_dict
 
-    def sample(self, evaluation_batch_size, eval_dict):
+    def generate(self, evaluation_batch_size, eval_dict):
         with torch.no_grad():
             if eval_dict['DYNAMIC']:
                 z = eval_dict['state'].guess().to(self.device)
@@ -210,17 +221,38 @@ class PLRGAN(Model):
                 z = self.generate_random_noise(evaluation_batch_size).to(self.device)
             generated_passwords = self.Generator(z)
             generated_passwords = torch.argmax(generated_passwords, 2)
-            generated_passwords = generated_passwords.type(torch.uint8)
-            generated_passwords = set([tuple(row.tolist()) for row in generated_passwords])
+            generated_passwords = generated_passwords.type(torch.uint8).cpu().numpy()
             eval_dict['z'] = z
             eval_dict['generated_passwords'] = generated_passwords
 
         return generated_passwords
 
+    def sample(self, evaluation_batch_size, eval_dict):
+        if eval_dict['sampler'] is not None:
+            return eval_dict['sampler'].sample()
+        return self.generate(evaluation_batch_size, eval_dict)
+
     def guessing_strategy(self, evaluation_batch_size, eval_dict):
         if eval_dict['DYNAMIC']:
-            for z, x in zip(eval_dict['z'], eval_dict['generated_passwords']):
-                eval_dict['state'](z, x)
+            positions = self.data.test_passwords.lookup(eval_dict['generated_passwords'])
+            eval_dict['state'](eval_dict['z'], positions)
+
+    def get_eval_state(self, eval_dict):
+        # Dynamic sampling and the parallel sampler are never used together.
+        if eval_dict['DYNAMIC']:
+            return eval_dict['state'].state_dict()
+        if eval_dict['sampler'] is not None:
+            return eval_dict['sampler'].state_dict()
+        return None
+
+    def set_eval_state(self, eval_dict, state):
+        if state is None:
+            return
+        if eval_dict['DYNAMIC']:
+            eval_dict['state'].load_state_dict(state)
+        elif eval_dict['sampler'] is not None:
+            eval_dict['sampler'].load_state_dict(state)
 
     def post_sampling(self, eval_dict):
-        pass
\ No newline at end of file
+        if eval_dict['sampler'] is not None:
+            eval_dict['sampler'].close()
\ No newline at end of file
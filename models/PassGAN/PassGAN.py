@@ -8,8 +8,11 @@ from datetime import timedelta
 from models.PassGAN.architecture import Generator, Discriminator
 from script.test.model import Model
 from script.dataset.dataset import Dataset
+from script.utils.parallel_sampler import ParallelSampler
 
 class PassGAN(Model):
+    encoded_samples = True
+
     def __init__(self, settings):
         self.Generator = None
         self.generator_opt = None
@@ -19,7 +22,7 @@ class PassGAN(Model):
         super().__init__(settings)
 
     def prepare_data(self, train_passwords, test_passwords, max_length):
-        return Dataset(train_passwords, test_passwords, max_length, self.test_hash)
+        return Dataset(train_passwords, test_passwords, max_length, self.train_hash, self.test_hash)
 
     def load(self, file_to_load):
         try:
@@ -100,6 +103,7 @@ class PassGAN(Model):
         n_matches = 0
 
         checkpoint_frequency = self.params['eval']['checkpoint_frequency']
+        prefetch_batches = int(self.params['train'].get('prefetch_batches', 0))
 
         self.init_model()
 
@@ -107,8 +111,8 @@ class PassGAN(Model):
 
             print(f"Epoch: {current_epoch + 1} / {epochs}")
 
-            for real_data in self.data.get_batches(batch_size=batch_size):
-                real_data = torch.tensor(real_data).to(self.device)
+            for real_data in self.data.get_batches(batch_size=batch_size, prefetch=prefetch_batches):
+                real_data = torch.as_tensor(real_data).to(self.device, non_blocking=True)
                 _ = self.train_discriminator(real_data)
                 disc_iteration_counter += 1
 
@@ -117,17 +121,13 @@ class PassGAN(Model):
                     gen_iteration_counter += 1
 
                     if gen_iteration_counter % checkpoint_frequency == 0:
-                        matches, _, _ = self.evaluate(n_samples=10**6, validation_mode=True)
-                        if matches >= n_matches:
-                            n_matches = matches
-
-                            obj = {
-                                'generator_opt': self.generator_opt.state_dict(),
-                                'discriminator_opt': self.discriminator_opt.state_dict(),
-                                'Generator': self.Generator.state_dict(),
-                                'Discriminator': self.Discriminator.state_dict(),
-                            }
-                            self.save(obj)
+                        obj = {
+                            'generator_opt': self.generator_opt.state_dict(),
+                            'discriminator_opt': self.discriminator_opt.state_dict(),
+                            'Generator': self.Generator.state_dict(),
+                            'Discriminator': self.Discriminator.state_dict(),
+                        }
+                        n_matches = self.save_best(self.validate_checkpoint(obj), n_matches)
 
                     progress_bar.update(1)
 
@@ -136,6 +136,8 @@ class PassGAN(Model):
 
             current_epoch += 1
 
+        n_matches = self.save_best(self.finish_validation(), n_matches)
+
         end = time.time()
         time_delta = timedelta(seconds=end - start)
         print(f"[T] - Training completed after: {time_delta}")
@@ -181,20 +183,42 @@ class PassGAN(Model):
         self.Generator.eval()
         eval_dict = {
             'n_samples': n_samples,
+            'sampler': None,
         }
+
+        n_workers = int(self.params['eval'].get('sampling_workers', 0))
+        if n_workers > 0 and self.device.type == 'cpu' and not self.validating:
+            print(f"[I] - Sampling with {n_workers} worker processes.")
+            eval_dict['sampler'] = ParallelSampler(lambda: self.generate(evaluation_batch_size), n_workers,
+                                                   (evaluation_batch_size, self.data.max_length),
+                                                   seed=int(self.params['eval'].get('sampling_seed', 0)))
         return eval_dict
 
-    def sample(self, evaluation_batch_size, eval_dict):
+    def generate(self, evaluation_batch_size):
         with torch.no_grad():
             z = self.generate_random_noise(evaluation_batch_size).to(self.device)
             generated_data = self.Generator(z)
             generated_data = torch.argmax(generated_data, 2)
-            generated_data = generated_data.type(torch.uint8)
-            generated_data = set([tuple(row.tolist()) for row in generated_data])
+            generated_data = generated_data.type(torch.uint8).cpu().numpy()
         return generated_data
 
+    def sample(self, evaluation_batch_size, eval_dict):
+        if eval_dict['sampler'] is not None:
+            return eval_dict['sampler'].sample()
+        return self.generate(evaluation_batch_size)
+
     def guessing_strategy(self, evaluation_batch_size, eval_dict):
         pass
 
+    def get_eval_state(self, eval_dict):
+        if eval_dict['sampler'] is None:
+            return None
+        return eval_dict['sampler'].state_dict()
+
+    def set_eval_state(self, eval_dict, state):
+        if state is not None and eval_dict['sampler'] is not None:
+            eval_dict['sampler'].load_state_dict(state)
+
     def post_sampling(self, eval_dict):
-        pass
\ No newline at end of file
+        if eval_dict['sampler'] is not None:
+            eval_dict['sampler'].close()
\ No newline at end of file
@@ -1,17 +1,20 @@
 import os
-import gzip
+import json
+import shutil
 from transformers import GPT2LMHeadModel, GPT2Config
 from transformers import TrainingArguments
 import time
 from datetime import timedelta
 import numpy as np
 import random
-from tqdm import trange
 from transformers import Trainer
+from datasets import load_from_disk
 
 from script.test.model import Model
+from script.utils.guesses_io import write_guesses
+from script.utils.password_index import load_test_index
 from models.PassGPT.passgpt_utils import *
-from models.PassGPT.create_tokenizer import create_tokenizer, load_tokenizer, create_dataset
+from models.PassGPT.create_tokenizer import create_tokenizer, load_tokenizer
 
 class PassGPT(Model):
     def __init__(self, settings):
@@ -22,10 +25,8 @@ class PassGPT(Model):
     def prepare_data(self, train_passwords, test_passwords, max_length):
         tokenizer_path = self.params['config']['tokenizer_path']
         tokenizer_path = os.path.join("models", "PassGPT", tokenizer_path, self.test_hash)
-        train_dataset = create_dataset(train_passwords, "train")
-        test_dataset = create_dataset(test_passwords, "test")
-        data = (tokenizer_path, train_dataset, test_dataset)
-        return data
+        test_passwords = load_test_index(self.path_to_test_dataset)
+        return PassGPTData(tokenizer_path, train_passwords, test_passwords)
 
     def save(self, file, mid=False):
         self.model.save_pretrained(file)
@@ -40,9 +41,9 @@ class PassGPT(Model):
 
     def init_tokenizer(self):
         TOKENIZER_MAX_LEN = int(self.max_length) + 2
-        tokenizer_path, train_dataset, test_dataset = self.data
+        tokenizer_path = self.data.tokenizer_path
         if not os.path.exists(tokenizer_path):
-            tokenizer_path = create_tokenizer(train_dataset, tokenizer_path, self.max_length)
+            tokenizer_path = create_tokenizer(self.data.train_passwords, tokenizer_path, self.max_length)
         self.tokenizer = load_tokenizer(tokenizer_path, TOKENIZER_MAX_LEN)
 
     def init_model(self, model_args):
@@ -56,9 +57,38 @@ class PassGPT(Model):
         self.model = GPT2LMHeadModel(config).to(self.device)
         print("Model initialized with {} parameters".format(sum(t.numel() for t in self.model.parameters())))
 
-    def train(self):
-        tokenizer_path, train_dataset, test_dataset = self.data
+    def load_tokenized_dataset(self, preprocess_function):
+        """
+        Tokenizes the training set once per train_hash (the checkpoint directory) and max_length. The tokenized dataset
+        is stored in Arrow format and memory-mapped by the next runs, as long as the tokenizer vocabulary is the same.
+        """
+        cache_path = os.path.join(self.path_to_checkpoint_dir, f"tokenized_train_{int(self.max_length)}")
+        vocab_path = os.path.join(cache_path, "tokenizer_vocab.json")
+        vocab = self.tokenizer.get_vocab()
+
+        if os.path.isfile(vocab_path):
+            with open(vocab_path, 'r') as f:
+                if json.load(f) == vocab:
+                    print(f"[I] - Loading tokenized training set from {cache_path}")
+                    return load_from_disk(cache_path)
+
+        print("[I] - Processing data")
+        train_dataset = self.data.train_dataset
+        tokenized_datasets = train_dataset.map(preprocess_function, batched=True,
+                                               remove_columns=train_dataset["train"].column_names)
 
+        # The vocabulary is written last, so an interrupted run never leaves a cache that looks complete.
+        tmp_path = f"{cache_path}.tmp"
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        tokenized_datasets.save_to_disk(tmp_path)
+        shutil.rmtree(cache_path, ignore_errors=True)
+        os.replace(tmp_path, cache_path)
+        with open(vocab_path, 'w') as f:
+            json.dump(vocab, f)
+
+        return load_from_disk(cache_path)
+
+    def train(self):
         training_args = self.params['train']
         training_args['output_dir'] = self.path_to_checkpoint_dir
         model_args = self.params['model_args']
@@ -81,9 +111,7 @@ class PassGPT(Model):
                              add_special_tokens=False,
                              return_special_tokens_mask=False)
 
-        print("[I] - Processing data")
-        tokenized_datasets = train_dataset.map(preprocess_function, batched=True,
-                                         remove_columns=train_dataset["train"].column_names)
+        tokenized_datasets = self.load_tokenized_dataset(preprocess_function)
         tokenized_datasets = tokenized_datasets.shuffle(seed=seed)
         tokenized_datasets.set_format(type="torch")
 
@@ -113,24 +141,12 @@ class PassGPT(Model):
         self.save(path)
 
     def write_to_file(self, file, data):
-        with gzip.open(file, 'wt') as f:
-            for psw in data:
-                f.write("{}\n".format(psw))
-
-    def evaluate(self, n_samples, validation_mode=False):
-        tokenizer_path, train_dataset, test_dataset = self.data
-        TOKENIZER_MAX_LEN = int(self.max_length) + 2
-
-        if not os.path.exists(tokenizer_path):
-            tokenizer_path = create_tokenizer(train_dataset, tokenizer_path, self.max_length)
+        write_guesses(file, data)
 
-        self.tokenizer = load_tokenizer(tokenizer_path, TOKENIZER_MAX_LEN)
+    def eval_init(self, n_samples, evaluation_batch_size):
+        self.init_tokenizer()
+        self.model.eval()
 
-        evaluation_batch_size = self.params["eval"]["evaluation_batch_size"]
-        num_beams = self.params["eval"]['num_beams']
-        temperature = self.params["eval"]['temperature']
-        top_p = self.params["eval"]['top_p']
-        top_k = self.params["eval"]['top_k']
         seed = self.params["eval"]["seed"]
 
         # Init random seeds
@@ -138,51 +154,40 @@ class PassGPT(Model):
         np.random.seed(seed)
         torch.manual_seed(seed)
 
-        assert n_samples % evaluation_batch_size == 0, "Number of passwords to generate should be divisible by batch size"
-
-        # Passwords generation
-        generations = []
         print("bos_token", self.tokenizer.bos_token_id)
 
-        save_guesses = self.save_guesses and not validation_mode
-        save_matches = self.save_matches and not validation_mode
-
-        for i in trange(int(n_samples / evaluation_batch_size)):
-            # Set seed for reproducibility
-            torch.manual_seed(seed + i)
-
-            with torch.no_grad():
-                # Generate tokens sampling from the distribution of codebook indices
-                g = self.model.generate(torch.tensor([[self.tokenizer.bos_token_id]]).cuda(device=self.device), do_sample=True,
-                                   max_length=TOKENIZER_MAX_LEN, pad_token_id=self.tokenizer.pad_token_id,
-                                   bad_words_ids=[[self.tokenizer.bos_token_id]], num_return_sequences=evaluation_batch_size,
-                                   num_beams=num_beams, top_p=top_p / 100, top_k=top_k,
-                                   temperature=temperature)
-
-                # Remove start of sentence token
-                g = g[:, 1:]
-
-            decoded = self.tokenizer.batch_decode(g.tolist())
-            decoded_clean = [i.split("</s>")[0] for i in decoded]  # Get content before end of password token
-
-            generations += decoded_clean
-
-            del g
-            del decoded
-            del decoded_clean
-
-        if save_guesses:
-            self.write_to_file(self.path_to_guesses_file, generations)
-
-        eval_passwords = set(test_dataset["test"]["text"])
-        matches = eval_passwords.intersection(set(generations))
-
-        if save_matches:
-            self.write_to_file(self.path_to_matches_file, list(matches))
-
-        matches = len(matches)
-        test_size = len(eval_passwords)
-        match_percentage = f'{(matches / test_size) * 100:.2f}%'
-        print(f'{matches} matches found ({match_percentage} of test set).')
-        return matches, match_percentage, test_size
-        
\ No newline at end of file
+        eval_dict = {
+            'seed': seed,
+            'batch': 0,
+            'max_new_tokens': int(self.max_length) + 1,
+            'temperature': self.params["eval"]['temperature'],
+            'top_p': self.params["eval"]['top_p'] / 100,
+            'top_k': self.params["eval"]['top_k'],
+        }
+        return eval_dict
+
+    def sample(self, evaluation_batch_size, eval_dict):
+        # Set seed for reproducibility
+        torch.manual_seed(eval_dict['seed'] + eval_dict['batch'])
+        eval_dict['batch'] += 1
+
+        # Generate tokens sampling from the distribution of codebook indices, <s> is not part of the output
+        tokens, lengths = sample_passwords(self.model, evaluation_batch_size, eval_dict['max_new_tokens'],
+                                           self.tokenizer.bos_token_id, self.tokenizer.eos_token_id,
+                                           self.tokenizer.pad_token_id, temperature=eval_dict['temperature'],
+                                           top_k=eval_dict['top_k'], top_p=eval_dict['top_p'])
+
+        # Get content before end of password token
+        return decode_samples(self.tokenizer, tokens, lengths)
+
+    def guessing_strategy(self, evaluation_batch_size, eval_dict):
+        pass
+
+    def get_eval_state(self, eval_dict):
+        return {'batch': eval_dict['batch']}
+
+    def set_eval_state(self, eval_dict, state):
+        eval_dict['batch'] = state['batch']
+
+    def post_sampling(self, eval_dict):
+        pass
@@ -41,22 +41,18 @@ class PassTokenizer(ByteLevelBPETokenizer):
         )
 
 def create_dataset(data, mode=""):
-    dataset = {"text": data}
+    dataset = {"text": list(data)}
     dataset = Dataset.from_dict(dataset)
     dataset = DatasetDict({mode: dataset})
     return dataset
 
 
-def create_tokenizer(train_data, output_path, max_length):
+def create_tokenizer(train_passwords, output_path, max_length):
     print("===> Reading passwords")
 
     # Filter printable passwords
-    ascii_printable = []
-    train_data = train_data["train"]
-    for k in train_data:
-        v = k["text"]
-        if all(32 < ord(c) < 128 for c in v) and (len(v) <= int(max_length)):
-            ascii_printable.append(v)
+    max_length = int(max_length)
+    ascii_printable = [v for v in train_passwords if len(v) <= max_length and all(32 < ord(c) < 128 for c in v)]
 
     # Log information about your data
     all_chars = ''.join(ascii_printable)  # concatenate all strings into a single string
@@ -4,6 +4,9 @@ import torch
 from transformers import BatchEncoding
 from transformers.data.data_collator import _torch_collate_batch
 
+from models.PassGPT.create_tokenizer import create_dataset
+from script.utils.kv_cache import select_cache_rows
+
 
 ########## UTILS FOR TRAINING ##########
 @dataclass
@@ -38,8 +41,109 @@ class PasswordDataCollator(DataCollatorForLanguageModeling):
         return batch
 
 
+class PassGPTData:
+    """
+    Data of PassGPT (self.data): the training passwords as a HF dataset and the test passwords as a TextPasswordIndex.
+    Generated passwords are already decoded by the tokenizer.
+    """
+
+    def __init__(self, tokenizer_path, train_passwords, test_passwords):
+        self.tokenizer_path = tokenizer_path
+        self.train_passwords = train_passwords
+        self.test_passwords = test_passwords
+        self._train_dataset = None
+
+    @property
+    def train_dataset(self):
+        # Only built when the training set has to be tokenized, see PassGPT.load_tokenized_dataset.
+        if self._train_dataset is None:
+            self._train_dataset = create_dataset(self.train_passwords, "train")
+        return self._train_dataset
+
+    def get_train_size(self):
+        return len(self.train_passwords)
+
+    def get_test_size(self):
+        return len(self.test_passwords)
+
+    def decode_password(self, password):
+        return password
+
+    def remove_padding(self, password):
+        return password
+
+
 class dotdict(dict):
     """dot.notation access to dictionary attributes"""
     __getattr__ = dict.get
     __setattr__ = dict.__setitem__
-    __delattr__ = dict.__delitem__
\ No newline at end of file
+    __delattr__ = dict.__delitem__
+
+########## UTILS FOR SAMPLING ##########
+def filter_logits(logits, top_k=None, top_p=1.0):
+    """
+    Sets to -inf the logits outside the top_k most probable tokens and outside the smallest set of tokens whose
+    cumulative probability reaches top_p, as done by the HF samplers.
+    """
+    if top_k is not None and 0 < top_k < logits.shape[-1]:
+        kth_logit = torch.topk(logits, top_k, dim=-1).values[:, -1:]
+        logits = logits.masked_fill(logits < kth_logit, float('-inf'))
+
+    if top_p is not None and top_p < 1.0:
+        sorted_logits, sorted_indices = torch.sort(logits, descending=False, dim=-1)
+        cumulative_probs = sorted_logits.softmax(dim=-1).cumsum(dim=-1)
+        sorted_to_remove = cumulative_probs <= (1 - top_p)
+        sorted_to_remove[:, -1] = False
+        to_remove = sorted_to_remove.scatter(1, sorted_indices, sorted_to_remove)
+        logits = logits.masked_fill(to_remove, float('-inf'))
+    return logits
+
+
+@torch.no_grad()
+def sample_passwords(model, batch_size, max_new_tokens, bos_token_id, eos_token_id, pad_token_id, temperature=1.0,
+                     top_k=None, top_p=1.0):
+    """
+    Samples batch_size sequences from <s>, feeding only the last token to the model at each step and reusing its
+    key/value cache. Rows that generated </s> are dropped from the batch (and from the cache), so finished passwords do
+    not cost any further compute.
+
+    Returns:
+        - tokens (torch.LongTensor): (batch_size, max_new_tokens) generated tokens, padded with pad_token_id after </s>.
+        - lengths (torch.LongTensor): number of tokens generated before </s> in each row.
+    """
+    device = next(model.parameters()).device
+
+    tokens = torch.full((batch_size, max_new_tokens), pad_token_id, dtype=torch.long, device=device)
+    lengths = torch.full((batch_size,), max_new_tokens, dtype=torch.long, device=device)
+    rows = torch.arange(batch_size, device=device)
+    input_ids = torch.full((batch_size, 1), bos_token_id, dtype=torch.long, device=device)
+    past_key_values = None
+
+    for step in range(max_new_tokens):
+        outputs = model(input_ids=input_ids, past_key_values=past_key_values, use_cache=True)
+        past_key_values = outputs.past_key_values
+
+        logits = outputs.logits[:, -1, :].float()
+        logits[:, bos_token_id] = float('-inf')
+        logits = filter_logits(logits / temperature, top_k, top_p)
+        next_tokens = torch.multinomial(logits.softmax(dim=-1), num_samples=1).squeeze(1)
+        tokens[rows, step] = next_tokens
+
+        finished = next_tokens == eos_token_id
+        if finished.any():
+            lengths[rows[finished]] = step
+            active = torch.nonzero(~finished).squeeze(1)
+            if len(active) == 0:
+                break
+            rows, next_tokens = rows[active], next_tokens[active]
+            past_key_values = select_cache_rows(past_key_values, active)
+
+        input_ids = next_tokens.unsqueeze(1)
+
+    return tokens, lengths
+
+
+def decode_samples(tokenizer, tokens, lengths):
+    # Decodes the tokens generated before </s> in each row.
+    tokens = tokens.tolist()
+    return tokenizer.batch_decode([row[:length] for row, length in zip(tokens, lengths.tolist())])
@@ -10,6 +10,7 @@ sys.path.append(os.path.join("models", "VGPT2"))
 from models.VGPT2.src.models.autoencoders import VAE
 
 from script.test.model import Model
+from script.utils.password_index import load_test_index
 from models.VGPT2.src.data.dataloader import TokenizedTextDataLoader
 
 class VGPT2(Model):
@@ -23,7 +24,8 @@ class VGPT2(Model):
     def prepare_data(self, train_passwords, test_passwords, max_length):
         params_dataloader = self.params['dataloader']
         TOKENIZER_MAX_LEN = max_length + 2
-        self.data = TokenizedTextDataLoader(train_passwords, set(test_passwords), TOKENIZER_MAX_LEN, params_dataloader)
+        test_passwords = load_test_index(self.path_to_test_dataset)
+        self.data = TokenizedTextDataLoader(train_passwords, test_passwords, TOKENIZER_MAX_LEN, params_dataloader)
         return self.data
 
     def load(self, file_to_load):
@@ -94,19 +96,18 @@ class VGPT2(Model):
                 progress_bar.update(len(batch[0]))
 
             if current_epoch % checkpoint_frequency == 0:
-                matches, _, _ = self.evaluate(n_samples=10 ** 6, validation_mode=True)
-                if matches >= n_matches:
-                    n_matches = matches
-                    obj = {
-                        'model': self.model.state_dict(),
-                        'optimizer': self.optimizer.state_dict(),
-                        'scheduler': self.scheduler.state_dict(),
-                    }
-                    self.save(obj)
+                obj = {
+                    'model': self.model.state_dict(),
+                    'optimizer': self.optimizer.state_dict(),
+                    'scheduler': self.scheduler.state_dict(),
+                }
+                n_matches = self.save_best(self.validate_checkpoint(obj), n_matches)
 
             self.scheduler.step()
             current_epoch += 1
 
+        n_matches = self.save_best(self.finish_validation(), n_matches)
+
         end = time.time()
         time_delta = timedelta(seconds=end - start)
         print(f"[T] - Training completed after: {time_delta}")
@@ -121,7 +122,7 @@ class VGPT2(Model):
     def sample(self, evaluation_batch_size, eval_dict):
         with torch.no_grad():
             generated_passwords, _ = self.model.generate(evaluation_batch_size)
-            generated_passwords = {self.data.tokenizer.decode(psw) for psw in generated_passwords}
+            generated_passwords = set(self.data.tokenizer.decode_many(generated_passwords))
         return generated_passwords
 
     def guessing_strategy(self, evaluation_batch_size, eval_dict):
@@ -5,6 +5,7 @@ from torch import nn as nn
 from models.VGPT2.src.blocks.base_block import Encoder, Decoder
 from models.VGPT2.src.utils.helper import Embedding, OneHotEncoding
 from models.VGPT2.src.utils.helper import sample as sample_dist
+from script.utils.kv_cache import select_cache_rows
 
 class GPT2Encoder(Encoder):
     def __init__(self, args, device):
@@ -155,9 +156,28 @@ class GPT2Decoder(Decoder):
         logits = transformer_outputs[0]  # [batch_size, sequence_length, V]
         return logits
 
+    def forward_step(self, z, x, past_key_values=None):
+        """
+        Same as forward for the last tokens x ([batch_size, 1]) only, the previous ones being in past_key_values.
+        Returns the logits of the next token and the updated key/value cache.
+        """
+        x = torch.cat((self.embedding(x), z.unsqueeze(1)), dim=-1)  # [batch_size, 1, embedding_dim + latent_dim]
+
+        if self.shared_encoder_weights:
+            x = self.encoder_mapping_layer(x)
+
+        if self.embedding_dropout_layer is not None:
+            x = self.embedding_dropout_layer(x)
+
+        transformer_outputs = self.transformer_model(inputs_embeds=x, past_key_values=past_key_values, use_cache=True)
+        return transformer_outputs.logits[:, -1, :], transformer_outputs.past_key_values
+
     def generate(self, z):
         """
         Autoregressive sampling from the model.
+
+        Only the last generated token is fed to the transformer at each step, the previous ones are read from its
+        key/value cache. Sequences that generated <EOS> are removed from the batch and from the cache.
         """
         batch_size = z.size(0)  # [batch_size, latent_dim]
 
@@ -168,12 +188,11 @@ class GPT2Decoder(Decoder):
         running_sequences = torch.arange(0, batch_size)
         generated = torch.LongTensor(batch_size, self.max_sequence_length).fill_(self.pad_index)
         sequence_lengths = torch.zeros(batch_size, dtype=torch.long)
+        past_key_values = None
 
         while t < self.max_sequence_length and len(running_sequences) > 0:
-            logits = self.forward(
-                x=input_sequence, z=z, lens=[t + 1] * input_sequence.shape[0]
-            )  # [batch_size, t, vocab_dim]
-            logits = logits[:, t, :]  # [batch_size, 1, vocab_dim]  -  last prediction only
+            logits, past_key_values = self.forward_step(z=z, x=input_sequence,
+                                                        past_key_values=past_key_values)  # [batch_size, vocab_dim]
 
             new_indices: torch.LongTensor = sample_dist(logits, "sample").type_as(generated)
             generated[running_sequences, t] = new_indices
@@ -184,9 +203,11 @@ class GPT2Decoder(Decoder):
                 running_mask = running_mask.unsqueeze(0)  # only one element remaining, running mask was 0-dimensional
             running_sequences = running_sequences.masked_select(running_mask)
 
-            input_sequence = torch.cat([input_sequence, new_indices.view(-1, 1).to(z.device)], dim=1)
-            input_sequence = input_sequence[running_mask]
-            z = z[running_mask]
+            input_sequence = new_indices.view(-1, 1).to(z.device)[running_mask.to(z.device)]
+            if not running_mask.all():
+                running_rows = torch.nonzero(running_mask).squeeze(1).to(z.device)
+                z = z[running_rows]
+                past_key_values = select_cache_rows(past_key_values, running_rows)
 
             t += 1
         return generated, sequence_lengths
@@ -1,9 +1,9 @@
 import torch
 import pickle
 import re
-import numpy as np
 
 from models.VGPT2.src.tokenizers.char_tokenizer import CharTokenizer
+from script.utils.password_index import TextPasswordIndex
 
 
 class TokenizedTextDataLoader:
@@ -20,20 +20,27 @@ class TokenizedTextDataLoader:
         self.batch_size = params["batch_size"]
         self.max_sequence_length = max_length
 
-        self.train_passwords = [self.tokenizer.encode(data) for data in train_passwords]
-        self.test_passwords = set(test_passwords)
+        # The training set is encoded once, as a single padded array and the length of each encoded password.
+        self.train_passwords, self.train_lengths = self.tokenizer.encode_many(train_passwords)
+        self.test_passwords = test_passwords
 
     def get_batches(self, batch_size=128, is_train=True):
-        data = self.train_passwords if is_train else self.test_passwords
+        # Only the training set is stored encoded (the test set is a PasswordIndex).
+        data = torch.from_numpy(self.train_passwords)
+        lengths = torch.from_numpy(self.train_lengths)
 
         for i in range(0, len(data) - batch_size + 1, batch_size):
-            batch = [torch.LongTensor(np.array(pwd)) for pwd in data[i:i + batch_size]]
-            yield self.collate_text_batch(batch, self.tokenizer.pad_index)
-
-    def collate_text_batch(self, batch, pad_index):
-        data = batch
-        lens = [len(x) for x in batch]
-        return torch.nn.utils.rnn.pad_sequence(data, batch_first=True, padding_value=pad_index), torch.tensor(lens)
+            # Views of the encoded set, padded up to the longest password of the batch.
+            lens = lengths[i:i + batch_size]
+            yield data[i:i + batch_size, :int(lens.max())], lens
+
+    def hold_out(self, n_passwords):
+        # Removes the last n_passwords passwords from the training set and returns them, decoded, as a
+        # TextPasswordIndex.
+        n_train = len(self.train_passwords) - n_passwords
+        held_out = TextPasswordIndex.from_passwords(self.tokenizer.decode_many(self.train_passwords[n_train:]))
+        self.train_passwords, self.train_lengths = self.train_passwords[:n_train], self.train_lengths[:n_train]
+        return held_out
 
     def get_test_size(self):
         return len(self.test_passwords)
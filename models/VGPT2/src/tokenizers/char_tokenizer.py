@@ -1,6 +1,9 @@
 import pickle
 import torch
 import re
+import numpy as np
+
+from script.utils.guesses_io import drop_zeros
 
 char = str
 
@@ -40,6 +43,12 @@ class CharTokenizer():
 
         self.vocab_size = len(self.char_to_index)
 
+        # Lookup tables of the batch methods: sorted code points of the characters, and code point of each index (0 for
+        # the special tokens, which are removed when decoding).
+        self.char_codes = np.array([ord(c) for c in self.characters], dtype=np.uint32)
+        self.index_to_code = np.zeros(self.vocab_size + 1, dtype=np.uint32)
+        self.index_to_code[:len(self.characters)] = self.char_codes
+
     def find_chars(self, data):
         unique_chars = sorted({char for password in data for char in password})
         return unique_chars
@@ -60,6 +69,51 @@ class CharTokenizer():
         indices = tuple(indices)
         return indices
 
+    def encode_many(self, texts, chunk_size=2 ** 20):
+        """
+        Batch version of encode. Returns the encoded texts as a single (n, longest + 2) int64 array, padded with
+        pad_index, and the number of indices of each text.
+        """
+        n_special = 2 if self.add_sos_and_eos else 0
+        lengths = np.fromiter(map(len, texts), dtype=np.int64, count=len(texts))
+        width = int(lengths.max(initial=0))
+        encoded = np.full((len(texts), width + n_special), self.pad_index, dtype=np.int64)
+
+        if self.add_sos_and_eos:
+            encoded[:, 0] = self.sos_index
+            encoded[np.arange(len(texts)), lengths + 1] = self.eos_index
+
+        for start in range(0, len(texts), chunk_size):
+            chunk = texts[start:start + chunk_size]
+            chunk_lengths = lengths[start:start + chunk_size]
+            codes = np.array(chunk, dtype=f'U{max(width, 1)}').view(np.uint32).reshape(len(chunk), -1)[:, :width]
+
+            indices = np.searchsorted(self.char_codes, codes)
+            known = indices < len(self.char_codes)
+            known[known] = self.char_codes[indices[known]] == codes[known]
+            indices = np.where(known, indices, self.unk_index)
+
+            in_text = np.arange(width) < chunk_lengths[:, None]
+            target = encoded[start:start + len(chunk), n_special // 2:n_special // 2 + width]
+            target[in_text] = indices[in_text]
+
+        return encoded, lengths + n_special
+
+    def decode_many(self, indices):
+        """
+        Batch version of decode, for a (n, sequence_length) tensor or array of indices.
+        """
+        if isinstance(indices, torch.Tensor):
+            indices = indices.cpu().numpy()
+        indices = np.asarray(indices)
+        if len(indices) == 0:
+            return []
+
+        codes = self.index_to_code[np.clip(indices, 0, self.vocab_size)]
+        # Special tokens are removed by moving their zeros to the end of each row.
+        codes = drop_zeros(codes)
+        return np.ascontiguousarray(codes).view(f'U{codes.shape[1]}').ravel().tolist()
+
     def decode(self, indices):
         chars = [
             self.index_to_char[index]
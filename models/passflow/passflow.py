@@ -8,7 +8,7 @@ from script.utils.file_operations import read_files
 
 from tqdm import tqdm
 
-from models.passflow.src.real_nvp.real_nvp import RealNVP
+from models.passflow.src.real_nvp.real_nvp import RealNVP, SampleType
 from models.passflow.src.real_nvp.coupling_layer import AffineTransform, MaskType
 
 from script.test.model import Model
@@ -45,15 +45,15 @@ def get_evaluation_params(n_samples):
 
 
 class PassFlow(Model):
+    encoded_samples = True
+
     def __init__(self, settings):
         self.model = None
         self.optimizer = None
         super().__init__(settings)
 
     def prepare_data(self, train_passwords, test_passwords, max_length):
-        data = Dataset(train_passwords, test_passwords, max_length, self.test_hash)
-        data.test_passwords = {np.array(password, dtype=np.uint8).tobytes() for password in data.test_passwords}
-        return data
+        return Dataset(train_passwords, test_passwords, max_length, self.train_hash, self.test_hash)
 
     def load(self, file_to_load):
         try:
@@ -68,8 +68,6 @@ class PassFlow(Model):
             return 0
 
     def init_model(self):
-        self.keep_uniques = True
-
         optimizer = torch.optim.Adam
         dim = self.data.max_length
         lr = self.params['train']['learning_rate']
@@ -153,6 +151,7 @@ class PassFlow(Model):
         current_epoch = 0
         n_matches = 0
         checkpoint_frequency = self.params['eval']['checkpoint_frequency']
+        prefetch_batches = int(self.params['train'].get('prefetch_batches', 0))
 
         self.init_model()
 
@@ -165,8 +164,8 @@ class PassFlow(Model):
                 bar.set_description(f'Epoch {current_epoch}')
                 batch_loss_history = []
 
-                for b in self.data.get_batches(batch_size):
-                    b = torch.tensor(b).to(self.device).float().contiguous()
+                for b in self.data.get_batches(batch_size, prefetch=prefetch_batches):
+                    b = torch.as_tensor(b).to(self.device, non_blocking=True).contiguous()
 
                     logit_x, log_det = self.preprocess(b)
                     log_prob = self.model.log_prob(logit_x)
@@ -185,51 +184,59 @@ class PassFlow(Model):
                     bar.update(b.size(0))
 
                 if current_epoch % checkpoint_frequency == 0:
-                    matches, _, _ = self.evaluate(n_samples=10 ** 6, validation_mode=True)
+                    obj = {
+                        'optimizer': self.optimizer.state_dict(),
+                        'net': self.model.state_dict(),
+                    }
+                    validations = self.validate_checkpoint(obj)
                     self.model.reset_prior()
 
-                    if current_epoch >= early_stop_epoch:
-                        threshold = int(n_matches + (n_matches * 0.05))
-                        if matches < threshold:
-                            early_stop_counter += 1
-                        else:
-                            early_stop_counter = 0
-
-                        if early_stop_counter >= 10:
-                            print("[I] - Early stopping")
-                            break
-
-                    if matches >= n_matches:
-                        n_matches = matches
-                        obj = {
-                            'optimizer': self.optimizer.state_dict(),
-                            'net': self.model.state_dict(),
-                        }
-                        self.save(obj)
+                    for matches, obj in validations:
+                        if current_epoch >= early_stop_epoch:
+                            threshold = int(n_matches + (n_matches * 0.05))
+                            if matches < threshold:
+                                early_stop_counter += 1
+                            else:
+                                early_stop_counter = 0
+
+                            if early_stop_counter >= 10:
+                                break
+
+                        if matches >= n_matches:
+                            n_matches = matches
+                            self.save(obj)
+
+                    if early_stop_counter >= 10:
+                        print("[I] - Early stopping")
+                        break
 
             current_epoch += 1
 
+        n_matches = self.save_best(self.finish_validation(), n_matches)
+
         end = time.time()
         time_delta = timedelta(seconds=end - start)
         print(f"[T] - Training completed after: {time_delta}")
 
-    def smoothen_samples(self, samples, uniques):
-        for idx, sample in enumerate(samples):
-            sample = np.around(samples[idx]).astype(np.uint8)
-            decoded_sample = sample.tobytes()
-            counter = 0
-            noise_d = 0.0
-            while decoded_sample in uniques:
-                if counter > 20:
-                    noise_d += 0.05
-                    counter = 0
-                    if noise_d >= 0.20:
-                        break
-                sample = np.around(samples[idx] + np.random.normal(0.0, self.params['train']['noise'] + noise_d, self.data.max_length)).astype(np.uint8)
-                decoded_sample = sample.tobytes()
-                counter += 1
-            samples[idx] = sample
-        return samples.astype(np.uint8)
+    def smoothen_samples(self, samples, seen):
+        # Samples already generated are perturbed with gaussian noise, in rounds over the rows that still collide. The
+        # noise grows every 21 rounds, and rows still colliding at noise 0.20 are kept as they are.
+        rounded = np.around(samples).astype(np.uint8)
+        colliding = np.flatnonzero(seen.contains(rounded))
+        noise_d = 0.0
+        counter = 0
+
+        while len(colliding):
+            if counter > 20:
+                noise_d += 0.05
+                counter = 0
+                if noise_d >= 0.20:
+                    break
+            noise = np.random.normal(0.0, self.params['train']['noise'] + noise_d, (len(colliding), self.data.max_length))
+            rounded[colliding] = np.around(samples[colliding] + noise).astype(np.uint8)
+            colliding = colliding[seen.contains(rounded[colliding])]
+            counter += 1
+        return rounded
 
     def around_sampling(self, password, num_samples, temperature=0.05):
         self.model.eval()
@@ -291,6 +298,9 @@ class PassFlow(Model):
         elif strategy == "gs":
             gs = True
 
+        # The gs strategy smooths the samples away from the passwords already generated, kept in self.seen.
+        self.keep_uniques = gs
+
         eval_dict = {
             'gs': gs,
             'ds': ds,
@@ -299,16 +309,17 @@ class PassFlow(Model):
         if ds or gs:
             p = get_evaluation_params(n_samples)
             alpha, sigma, gamma = p['alpha'], p['sigma'], p['gamma']
-            matched_history = dict()
             count_samples = 0
 
+            # matched_history is stored as parallel arrays: the positions of the matched passwords in the test set index,
+            # and the number of times each of them was used as a prior mean.
             eval_dict.update({
                 'alpha': alpha,
                 'sigma': sigma,
                 'gamma': gamma,
-                'matched_history': matched_history,
+                'matched_positions': np.empty(0, dtype=np.int64),
+                'matched_counts': np.empty(0, dtype=np.int64),
                 'count_samples': count_samples,
-                'old_matches': set(),
                 'dim': self.data.max_length,
             })
 
@@ -320,42 +331,62 @@ class PassFlow(Model):
             raw_samples = self.model.sample(evaluation_batch_size)
             samples = self.preprocess(raw_samples, reverse=True).to('cpu').numpy()
 
-            if eval_dict['gs'] and self.guesses is not None and self.params['train']['noise'] != 0:
-                samples = self.smoothen_samples(samples, set(self.guesses))
+            if eval_dict['gs'] and self.params['train']['noise'] != 0:
+                samples = self.smoothen_samples(samples, self.seen)
             else:
                 samples = np.around(samples).astype(np.uint8)
-
-            encoded_samples = {x.tobytes() for x in samples}
-            return encoded_samples
+            return samples
 
     def guessing_strategy(self, evaluation_batch_size, eval_dict):
         if eval_dict['gs'] or eval_dict['ds']:
             self.dynamic_sampling(evaluation_batch_size, eval_dict)
 
-    def post_sampling(self, eval_dict):
-        self.guesses = [tuple(np.frombuffer(x, dtype=np.uint8)) for x in self.guesses]
-        self.matches = [tuple(np.frombuffer(x, dtype=np.uint8)) for x in self.matches]
+    def get_eval_state(self, eval_dict):
+        if not (eval_dict['gs'] or eval_dict['ds']):
+            return None
+
+        prior = None
+        if self.model.sample_type == SampleType.DYNAMIC:
+            prior = (self.model.prior.loc.cpu().numpy(), self.model.prior.scale.cpu().numpy())
+        return {
+            'matched_positions': eval_dict['matched_positions'],
+            'matched_counts': eval_dict['matched_counts'],
+            'count_samples': eval_dict['count_samples'],
+            'prior': prior,
+        }
+
+    def set_eval_state(self, eval_dict, state):
+        if state is None:
+            return
 
+        eval_dict['matched_positions'] = state['matched_positions']
+        eval_dict['matched_counts'] = state['matched_counts']
+        eval_dict['count_samples'] = state['count_samples']
+        if state['prior'] is not None:
+            self.model.set_prior(*state['prior'])
+
+    def post_sampling(self, eval_dict):
         self.model.reset_prior()
 
     def dynamic_sampling(self, evaluation_batch_size, eval_dict):
-        new_matches = set(self.matches) - eval_dict['old_matches']
-
-        for match in new_matches:
-            eval_dict['matched_history'][match] = 0
+        # New matches enter the history with a count of 0.
+        new_matches = self.matches.new_matches.astype(np.int64)
+        eval_dict['matched_positions'] = np.concatenate([eval_dict['matched_positions'], new_matches])
+        eval_dict['matched_counts'] = np.concatenate([eval_dict['matched_counts'], np.zeros(len(new_matches), np.int64)])
 
         with torch.no_grad():
-            if len(self.matches) >= eval_dict['alpha'] and len(eval_dict['matched_history']) > 0:
-                idxs = np.random.randint(0, len(eval_dict['matched_history']), evaluation_batch_size, np.int32)
+            if len(self.matches) >= eval_dict['alpha'] and len(eval_dict['matched_positions']) > 0:
+                idxs = np.random.randint(0, len(eval_dict['matched_positions']), evaluation_batch_size, np.int32)
 
-                key_list = np.fromiter(eval_dict['matched_history'].keys(), dtype=object)[idxs]
-                encoded_key_list = np.array([np.frombuffer(key, dtype=np.uint8) for key in key_list])
+                key_list = eval_dict['matched_positions'][idxs]
+                encoded_key_list = self.data.test_passwords.passwords(key_list)
 
-                for key in key_list:
-                    if key in eval_dict['matched_history']:
-                        eval_dict['matched_history'][key] += 1
-                        if eval_dict['matched_history'][key] > eval_dict['gamma']:
-                            del eval_dict['matched_history'][key]
+                # Every use increments the count of the password, which leaves the history once used more than gamma
+                # times.
+                eval_dict['matched_counts'] += np.bincount(idxs, minlength=len(eval_dict['matched_counts']))
+                keep = eval_dict['matched_counts'] <= eval_dict['gamma']
+                eval_dict['matched_positions'] = eval_dict['matched_positions'][keep]
+                eval_dict['matched_counts'] = eval_dict['matched_counts'][keep]
 
                 x = torch.FloatTensor(encoded_key_list).to(self.device)
                 x, _ = self.preprocess(x)
@@ -366,5 +397,3 @@ class PassFlow(Model):
                 self.model.set_prior(dynamic_mean, dynamic_var)
             else:
                 self.model.reset_prior()
-
-        eval_dict['old_matches'] = set(self.matches)
\ No newline at end of file
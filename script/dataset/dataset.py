@@ -1,55 +1,95 @@
 import collections
 import os
-import pickle
+import json
 import numpy as np
+import torch
+
+from script.utils.password_index import PasswordIndex
+from script.utils.prefetcher import Prefetcher
+from script.utils.guesses_io import decode_rows
 
 SAVE_FOLDER = "./data/dataset"
 if not os.path.exists(os.path.join(os.getcwd(), SAVE_FOLDER)):
     os.makedirs(os.path.join(os.getcwd(), SAVE_FOLDER), exist_ok=True)
 
 class Dataset:
-    def __init__(self, train_passwords, test_passwords, max_length, name):
-        self.name = name
+    def __init__(self, train_passwords, test_passwords, max_length, train_hash, test_hash):
+        self.train_hash = train_hash
+        self.test_hash = test_hash
         self.max_length = int(max_length)
 
-        self.train_passwords = list(train_passwords)
-        self.test_passwords = set(test_passwords)
+        self.train_passwords = train_passwords
+        self.test_passwords = test_passwords
 
         self.charmap = {}
         self.inv_charmap = []
 
-        if not self.load():
+        # The encoded training set is cached per train_hash and the test set index per test_hash, so that the test
+        # variants of the same training split share its encoding.
+        if not self.load(is_train=True):
             self.load_dataset(is_train=True)
+            self.save(is_train=True)
+
+        if not self.load(is_train=False):
             self.load_dataset(is_train=False)
+            self.save(is_train=False)
 
         self.charmap_size = len(self.charmap)
-        self.save()
 
         print(f'train {len(self.train_passwords)} test {len(self.test_passwords)}')
 
     def get_train_size(self):
         return len(self.train_passwords)
 
-    def load(self):
-        full_path = os.path.join(SAVE_FOLDER, self.name + ".pickle")
-        if os.path.exists(full_path):
-            print(f'Loading dataset {full_path} from pickle.')
-            with open(full_path, 'rb') as fin:
-                loaded = pickle.load(fin)
-            if loaded['max_length'] == self.max_length:
-                self.__dict__.update(loaded)
-                print(f'Loaded dataset {full_path} from pickle.')
-                return True
-
-            print(f'{full_path} saved on disk has different parameters from current run. Rebuilding')
-        return False
-
-    def save(self):
-        full_path = os.path.join(SAVE_FOLDER, self.name + ".pickle")
-        if not os.path.exists(full_path):
-            with open(full_path, 'wb') as fout:
-                pickle.dump(self.__dict__, fout)
-                print('Pickled dataset saved')
+    def cache_path(self, is_train=True):
+        # Each split is cached as a .npy array of encoded rows, plus a .json header holding the charmap it uses.
+        if is_train:
+            return os.path.join(SAVE_FOLDER, f"train-{self.train_hash}")
+        return os.path.join(SAVE_FOLDER, f"test-{self.test_hash}")
+
+    def load(self, is_train=True):
+        path = self.cache_path(is_train)
+        if not (os.path.exists(f'{path}.npy') and os.path.exists(f'{path}.json')):
+            return False
+
+        with open(f'{path}.json') as fin:
+            header = json.load(fin)
+        if header['max_length'] != self.max_length:
+            print(f'{path}.npy saved on disk has different parameters from current run. Rebuilding')
+            return False
+
+        # The test set is encoded with the charmap of the training set, it is rebuilt if the charmap changed.
+        if not is_train and header['inv_charmap'] != self.inv_charmap:
+            print(f'{path}.npy was encoded with a different charmap. Rebuilding')
+            return False
+
+        # The arrays are memory-mapped, so they are loaded in constant time.
+        if is_train:
+            self.inv_charmap = header['inv_charmap']
+            self.charmap = {char: i for i, char in enumerate(self.inv_charmap)}
+            self.train_passwords = np.load(f'{path}.npy', mmap_mode='r')
+        else:
+            self.test_passwords = PasswordIndex.load(f'{path}.npy')
+
+        print(f'Loaded {"training" if is_train else "test"} set from {path}.npy.')
+        return True
+
+    def save(self, is_train=True):
+        path = self.cache_path(is_train)
+        if is_train:
+            tmp_path = f'{path}.{os.getpid()}.tmp'
+            with open(tmp_path, 'wb') as fout:
+                np.save(fout, np.ascontiguousarray(self.train_passwords))
+            os.replace(tmp_path, f'{path}.npy')
+        else:
+            self.test_passwords.save(f'{path}.npy')
+
+        # The header is written last, a split is only loaded from the cache once both files exist.
+        tmp_path = f'{path}.json.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as fout:
+            json.dump({'max_length': self.max_length, 'inv_charmap': self.inv_charmap}, fout)
+        os.replace(tmp_path, f'{path}.json')
+        print(f'{"Training" if is_train else "Test"} set saved to {path}.npy.')
 
     def load_dataset(self, max_vocab_size=2048, is_train=True):
         lines = []
@@ -89,9 +129,11 @@ class Dataset:
                 passwords.append(tuple(filtered_line))
 
         if is_train:
-            self.train_passwords = [tuple(self.encode_password(pwd)) for pwd in passwords]
+            # The training set is kept as a single contiguous (N, max_length) array of encoded passwords.
+            self.train_passwords = self.encode_rows([self.encode_password(pwd) for pwd in passwords])
         else:
-            self.test_passwords = set([tuple(self.encode_password(pwd)) for pwd in passwords])
+            self.test_passwords = PasswordIndex.from_rows([self.encode_password(pwd) for pwd in passwords],
+                                                          self.max_length)
 
         print('{} set: loaded {} out of {} lines in dataset. {} filtered'
               .format('Training' if is_train else 'Test', len(passwords), len(lines), len(lines) - len(passwords)))
@@ -99,6 +141,9 @@ class Dataset:
     def encode_password(self, password):
         return [self.charmap[c] for c in password]
 
+    def encode_rows(self, encoded_passwords):
+        return np.array(encoded_passwords, dtype=np.uint8).reshape(-1, self.max_length)
+
     def decode_password(self, encoded_password):
         decoded_password = ''
         for c in encoded_password:
@@ -108,16 +153,41 @@ class Dataset:
                 return None
         return decoded_password
 
+    def decode_passwords(self, encoded_passwords):
+        # Same as decode_password followed by remove_padding, for a whole (batch, max_length) array at once.
+        return decode_rows(encoded_passwords, self.inv_charmap, padding='`')
+
+    def valid_rows(self, rows):
+        # Mask of the encoded rows that decode_password is able to decode.
+        return np.all(rows < self.charmap_size, axis=1)
+
     def pad_password(self, password):
         return password + (("`",) * (self.max_length - len(password)))
 
     def remove_padding(self, password):
         return password.replace('`', '')
 
-    def get_batches(self, batch_size=128, is_train=True):
-        data = self.train_passwords if is_train else self.test_passwords
-
-        np.random.shuffle(data)
-
-        for i in range(0, len(data) - batch_size + 1, batch_size):
-            yield np.array([np.array(pwd) for pwd in data[i:i + batch_size]], dtype='float32')
\ No newline at end of file
+    def hold_out(self, n_passwords):
+        # Removes the last n_passwords passwords from the training set (shuffled once, when it was encoded) and returns
+        # them as a PasswordIndex.
+        n_train = len(self.train_passwords) - n_passwords
+        held_out = PasswordIndex.from_rows(self.train_passwords[n_train:], self.max_length)
+        self.train_passwords = self.train_passwords[:n_train]
+        return held_out
+
+    def get_batches(self, batch_size=128, is_train=True, prefetch=0):
+        """
+        Yields the shuffled passwords as (batch_size, max_length) float32 batches, gathered from the encoded rows
+        through a permutation. With prefetch > 0, up to `prefetch` batches are assembled ahead by a background thread,
+        as torch tensors in pinned memory when CUDA is available, so that they can be copied with non_blocking=True.
+        """
+        rows = self.train_passwords if is_train else self.test_passwords.rows
+        permutation = np.random.permutation(len(rows))
+        batches = (rows[permutation[i:i + batch_size]].astype(np.float32)
+                   for i in range(0, len(rows) - batch_size + 1, batch_size))
+        if prefetch <= 0:
+            return batches
+
+        pin_memory = torch.cuda.is_available()
+        tensors = (torch.from_numpy(batch).pin_memory() if pin_memory else torch.from_numpy(batch) for batch in batches)
+        return iter(Prefetcher(tensors, prefetch))
\ No newline at end of file
@@ -4,7 +4,7 @@ import glob
 
 from script.config.config import *
 from script.utils.download_raw_data import main as download_raw_data
-from script.utils.file_operations import write_to_csv
+from script.utils.file_operations import write_to_csv, change_extension
 from script.test.tester import Tester
 
 RESULTS_PATH = "results"
@@ -165,6 +165,8 @@ class Evaluator:
                     hash = [d for d in os.listdir(setting_path) if os.path.isdir(os.path.join(setting_path, d))][0]
 
                     match_file = os.path.join(setting_path, hash, mode, f"{mode}.gz")
+                    if not os.path.exists(match_file) and os.path.exists(change_extension(match_file, "bin")):
+                        match_file = change_extension(match_file, "bin")
                     if not os.path.exists(match_file):
                         status = self._run_missing_entry(test, model, dataset, setting_string)
                         if not status:
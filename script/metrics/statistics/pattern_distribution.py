@@ -1,7 +1,7 @@
 import os
 import re
 import pickle
-import gzip
+from script.utils.file_operations import load_guesses_chunk
 from script.metrics.statistics.evaluator import Evaluator
 
 regex = {
@@ -37,9 +37,8 @@ def read_chunk(file, chunk_size=20480):
         if chunk:
             yield chunk
 
-    if file.endswith('.gz'):
-        with gzip.open(file, 'rt') as f:
-            yield from read_lines(f)
+    if file.endswith('.gz') or file.endswith('.bin'):
+        yield from load_guesses_chunk(file, chunk_size)
     elif file.endswith('.txt'):
         with open(file, 'r') as f:
             yield from read_lines(f)
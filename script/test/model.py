@@ -1,21 +1,37 @@
+import copy
 import math
 import os
-import gzip
 import time
 import pickle
+import traceback
+import multiprocessing
 from tqdm import tqdm
 import shutil
 import torch
 import glob
+import itertools
+import random
+import numpy as np
 
+from collections.abc import Sequence
 from datetime import timedelta
-from script.utils.file_operations import redirect_stdout, redirect_stderr, write_to_csv
+from script.utils.file_operations import redirect_stdout, redirect_stderr, write_to_csv, change_extension
+from script.utils.guesses_io import write_guesses, write_guesses_bin, get_file_state, restore_file_state
+from script.utils.async_writer import AsyncWriter
 from script.utils.memory_usage import reset_memory_info, print_memory_info
-from script.utils.fast_eval import check_skip_generation, sub_sample, fast_eval
+from script.utils.fast_eval import check_skip_generation, sub_sample, fast_eval, evaluate_thresholds, get_ranks_path, \
+    save_ranks
+from script.utils.match_tracker import MatchTracker
+from script.utils.password_index import TextPasswordIndex, unique_rows
+from script.utils.seen_set import create_seen_set
 from script.config.config import read_config
 
 
 class Model:
+    # Set to True by the models whose sample returns encoded rows (uint8 arrays), which can be stored in the binary
+    # guesses format.
+    encoded_samples = False
+
     def __init__(self, s):
         self.settings = s
 
@@ -27,10 +43,19 @@ class Model:
         # Dictionary containing the model parameters loaded from the .yaml config file.
         self.params = read_config(self.path_to_config_file)
 
-        train_passwords = read_dataset(self.path_to_train_dataset)
-        test_passwords = read_dataset(self.path_to_test_dataset)
+        # Models generating encoded rows (PassGAN, PLRGAN, PassFlow) can store their guesses in the binary format.
+        if self.params.get('eval', {}).get('guesses_format', 'gz') == 'bin':
+            if self.encoded_samples:
+                self.path_to_guesses_file = change_extension(self.path_to_guesses_file, 'bin')
+            else:
+                print(f"[W] - {type(self).__name__} generates plain strings, guesses are stored as .gz instead of .bin.")
 
-        self.data = self.prepare_data(train_passwords, test_passwords, self.max_length)
+        # self.data is only prepared when it is first used, see the data property.
+        self._data = None
+        self.validation_passwords = None
+        self.pending_validation = None
+        # True while self.validate runs, so that eval_init does not start sampling worker processes.
+        self.validating = False
 
         self._setup_checkpoint()
 
@@ -82,6 +107,7 @@ class Model:
         self.path_to_guesses_file = os.path.join(self.path_to_guesses_dir, "guesses.gz")
         self.path_to_matches_dir = os.path.join(self.path_to_results_dir, "matches")
         self.path_to_matches_file = os.path.join(self.path_to_matches_dir, "matches.gz")
+        self.path_to_eval_checkpoint = os.path.join(self.path_to_results_dir, "eval_checkpoint.pt")
 
     def _setup_logging(self):
         self.written_rows = {}
@@ -117,7 +143,8 @@ class Model:
         n_samples_to_evaluate = sorted(self.settings.get("n_samples"))
 
         if not self.overwrite:
-            if os.path.isfile(self.path_to_guesses_file):
+            # A guesses file with an evaluation checkpoint belongs to an interrupted run, which is resumed instead.
+            if os.path.isfile(self.path_to_guesses_file) and not os.path.isfile(self.path_to_eval_checkpoint):
                 output = fast_eval(self.path_to_test_dataset, n_samples_to_evaluate, self.path_to_guesses_file)
                 self.save_stats(output)
                 return True
@@ -138,6 +165,15 @@ class Model:
         return sub_samples_from_file or guesses_file
 
     def _prepare_directories(self):
+        if not self.overwrite and os.path.isfile(self.path_to_eval_checkpoint):
+            # Whether the checkpoint is actually resumed is only known in evaluate, which cleans the outputs otherwise.
+            print(f"[I] - Found evaluation checkpoint {self.path_to_eval_checkpoint}, keeping previous outputs.")
+            return
+        self._clean_outputs()
+
+    def _clean_outputs(self):
+        if os.path.isfile(self.path_to_eval_checkpoint):
+            os.remove(self.path_to_eval_checkpoint)
         if self.save_guesses:
             _create_and_clean_dir(self.path_to_guesses_dir)
         if self.save_matches:
@@ -159,9 +195,32 @@ class Model:
         self.save_stats(output)
 
         if len(self.thresholds) > 0:
-            output = fast_eval(self.path_to_test_dataset, self.thresholds, self.path_to_guesses_file)
+            if self._matches_text_index():
+                # First-hit ranks were recorded during sampling, no need to read the guesses file again.
+                output = evaluate_thresholds(self.matches.hit_ranks(), self.matches.n_guesses, test_size,
+                                             sorted(self.thresholds))
+            else:
+                output = fast_eval(self.path_to_test_dataset, self.thresholds, self.path_to_guesses_file)
             self.save_stats(output)
 
+    def _matches_text_index(self):
+        # Whether self.matches counts against the text index of the test split (load_test_index), like fast_eval.
+        # Models built on a Dataset match against its own index, which drops the passwords it can not encode.
+        return isinstance(self.data.test_passwords, TextPasswordIndex)
+
+    @property
+    def data(self):
+        # Runs that only re-score existing guesses (fast eval, --guesses_file, --sub_samples_from_file) never prepare
+        # the data, and the splits are read from disk only if prepare_data actually uses them.
+        if self._data is None:
+            self._data = self.prepare_data(LazySplit(self.path_to_train_dataset), LazySplit(self.path_to_test_dataset),
+                                           self.max_length)
+        return self._data
+
+    @data.setter
+    def data(self, data):
+        self._data = data
+
     def save_stats(self, output):
         if output:
             fieldnames = ["model", "train-dataset", "test-settings", "test-hash", "test-size", "n_samples", "matches",
@@ -202,6 +261,7 @@ class Model:
             status = self.load(file_to_load)
             if not status:
                 print("[I] - No checkpoints found. Proceeding with normal training.")
+                self.hold_out_validation()
                 self.train()
                 self.finalize_checkpoint()
             else:
@@ -209,9 +269,28 @@ class Model:
 
         else:
             print("[I] - Checkpoint not specified. Starting training from scratch.")
+            self.hold_out_validation()
             self.train()
             self.finalize_checkpoint()
 
+    def hold_out_validation(self):
+        # The last `validation_size` training passwords (train section of the config file, at most 10% of the training
+        # set) are removed from the training set and used by self.validate. Without it, validate uses the test set.
+        if self.validation_passwords is not None:
+            return
+
+        validation_size = int(self.params['train'].get('validation_size', 0))
+        if validation_size <= 0:
+            self.validation_passwords = self.data.test_passwords
+            return
+
+        n_passwords = min(validation_size, self.data.get_train_size() // 10)
+        if n_passwords > 0:
+            print(f"[I] - Holding out {n_passwords} training passwords for validation.")
+            self.validation_passwords = self.data.hold_out(n_passwords)
+        else:
+            self.validation_passwords = self.data.test_passwords
+
     def start_eval(self, checkpoint_name):
         print("[I] - Searching for a checkpoint for evaluation...")
         file_to_load = os.path.join(self.path_to_checkpoint_dir, self.checkpoint_name)
@@ -240,14 +319,32 @@ class Model:
                 print(f"[E] - Error during embedding: {e}")
         return False
 
+    def write_guesses(self, batches):
+        if isinstance(batches[0], np.ndarray):
+            guesses = np.concatenate(batches)
+        else:
+            guesses = itertools.chain.from_iterable(batches)
+
+        if self.path_to_guesses_file.endswith('.bin'):
+            write_guesses_bin(self.path_to_guesses_file, guesses, self.data.inv_charmap)
+        else:
+            self.write_to_file(self.path_to_guesses_file, guesses)
+
     def write_to_file(self, file, generated_data):
-        with gzip.open(file, 'at') as file:
-            for password in generated_data:
+        if isinstance(generated_data, np.ndarray):
+            # Encoded passwords are decoded as a whole batch.
+            decoded_passwords = self.data.decode_passwords(generated_data)
+            write_guesses(file, (password for password in decoded_passwords if password is not None))
+            return
+
+        def decode(passwords):
+            for password in passwords:
                 decoded_password = self.data.decode_password(password)
                 if decoded_password is None:
                     continue
-                password = self.data.remove_padding(decoded_password)
-                file.write(password + '\n')
+                yield self.data.remove_padding(decoded_password)
+
+        write_guesses(file, decode(generated_data))
 
     def prepare_data(self, train_passwords, test_passwords, max_length):
         """
@@ -257,18 +354,28 @@ class Model:
 
         The returned object must include at least the following attributes:
             - train_passwords (list): A list of training passwords.
-            - test_passwords (set): A set of test passwords.
+            - test_passwords (PasswordIndex): The test passwords, stored in a PasswordIndex (see
+            script/utils/password_index.py). If your model generates plain strings, use
+            load_test_index(self.path_to_test_dataset), which memory-maps the index shared by all models.
 
         Additionally, the object MUST implement the following methods:
 	        - encode_password(password): Takes a password string and returns its tokenized representation.
 	        - decode_password(password): Takes a tokenized password and returns the corresponding string after detokenization.
             - remove_padding(password): Takes a padded password string and returns the same string with all padding tokens removed.
+            - valid_rows(rows): Only required if sample returns arrays. Takes a batch of encoded passwords and returns a
+            boolean mask of the ones that decode_password is able to decode.
+            - decode_passwords(rows): Only required if sample returns arrays. Batch version of decode_password followed
+            by remove_padding, returns a list of strings (None for the passwords that can not be decoded).
+            - hold_out(n_passwords): Only required if `validation_size` is set in the train section of the config file.
+            Removes n_passwords passwords from the training set and returns them as a PasswordIndex (TextPasswordIndex
+            if sample returns strings), matched by self.validate.
 
         Parameters:
 	        - self (Model): The model instance. You can access all variables and methods defined in this class, including
 	        self.data (the object returned by prepare_data) and self.params (the configuration parameters).
-            - train_passwords (list): The list of passwords used for training.
-            - test_passwords (list): The list of passwords used for testing.
+            - train_passwords (LazySplit): The passwords used for training, a sequence of strings read from disk when it
+            is first used (call list() on it if you need an actual list).
+            - test_passwords (LazySplit): The passwords used for testing.
             - max_length (int): The maximum allowed password length.
         Returns:
              - An object containing the required attributes and methods, which will be later accessible via self.data.
@@ -315,6 +422,97 @@ class Model:
         """
         raise NotImplementedError('This method should be implemented in the subclass.')
 
+    def validate(self):
+        """
+        Lightweight evaluation used by the trainers to select checkpoints. Samples `validation_samples` passwords (eval
+        section of the config file, default: 10**6) and returns the number of validation passwords they match. Nothing
+        is written, and the guessing strategy is not run.
+        """
+        if self.validation_passwords is None:
+            self.hold_out_validation()
+
+        n_samples = int(self.params['eval'].get('validation_samples', 10 ** 6))
+        evaluation_batch_size = int(self.params['eval']['evaluation_batch_size'])
+        if n_samples < evaluation_batch_size:
+            n_batches, evaluation_batch_size = 1, n_samples
+        else:
+            n_batches = math.floor(n_samples / evaluation_batch_size)
+
+        self.validating = True
+        try:
+            eval_dict = self.eval_init(n_samples, evaluation_batch_size)
+            matches = MatchTracker(self.validation_passwords, max_rank=n_samples)
+            self.seen = create_seen_set(self.data.max_length) if self.keep_uniques else None
+
+            for _ in range(n_batches):
+                generated_passwords = self.sample(evaluation_batch_size, eval_dict)
+                matches.update(generated_passwords)
+                if self.seen is not None:
+                    self.seen.add(generated_passwords[self.data.valid_rows(generated_passwords)])
+
+            self.post_sampling(eval_dict)
+        finally:
+            self.validating = False
+            self.seen = None
+
+        print(f"[I] - Validation: {len(matches)} matches out of {len(self.validation_passwords)} passwords.")
+        return len(matches)
+
+    def validate_checkpoint(self, checkpoint):
+        """
+        Validates the current weights, whose checkpoint (the dictionary given to self.save) is `checkpoint`. Returns the
+        list of (matches, checkpoint) of the validations finished by this call, see save_best.
+
+        With `validation_in_background: 1` (eval section of the config file, CPU only), the validation runs in a forked
+        process, on a copy-on-write snapshot of the model, while the training goes on. Its result is returned by the
+        next call, or by finish_validation at the end of the training.
+        """
+        finished = self.finish_validation()
+        if not int(self.params['eval'].get('validation_in_background', 0)) or self.device.type != 'cpu':
+            finished.append((self.validate(), checkpoint))
+            return finished
+
+        context = multiprocessing.get_context('fork')
+        receiver, sender = context.Pipe(duplex=False)
+        # Not a daemon, so that the validation can fork itself if needed. It is always joined by finish_validation.
+        process = context.Process(target=self._validate_in_child, args=(sender,))
+        process.start()
+        sender.close()
+        # The state dicts share their storage with the weights, which keep being trained.
+        self.pending_validation = (process, receiver, copy.deepcopy(checkpoint))
+        return finished
+
+    def _validate_in_child(self, sender):
+        try:
+            sender.send((self.validate(), None))
+        except Exception:
+            sender.send((None, traceback.format_exc()))
+
+    def finish_validation(self):
+        # Waits for the background validation, if any, and returns its (matches, checkpoint) in a list.
+        if self.pending_validation is None:
+            return []
+
+        process, receiver, checkpoint = self.pending_validation
+        self.pending_validation = None
+        try:
+            matches, error = receiver.recv()
+        except EOFError:
+            matches, error = None, "the process exited without a result."
+        receiver.close()
+        process.join()
+        if error is not None:
+            raise RuntimeError(f"Validation process failed:\n{error}")
+        return [(matches, checkpoint)]
+
+    def save_best(self, validations, n_matches):
+        # Saves the checkpoints of `validations` matching at least n_matches passwords, returns the best match count.
+        for matches, checkpoint in validations:
+            if matches >= n_matches:
+                n_matches = matches
+                self.save(checkpoint)
+        return n_matches
+
     def evaluate(self, n_samples, validation_mode=False):
         print(f"Generating {n_samples} passwords...")
         save_every = 1000000
@@ -329,24 +527,73 @@ class Model:
 
         eval_dict = self.eval_init(n_samples, evaluation_batch_size)
 
-        progress_bar = tqdm(range(n_batches))
-        progress_bar.set_description(desc='Generating sample batch')
-
+        # Guesses are buffered as whole batches and flushed every `save_every` passwords, while matches are
+        # accounted against the test set index. Memory depends on the batch size, not on n_samples.
+        # Flushed guesses are written by a background thread while the next batches are sampled.
         self.guesses = []
-        self.matches = set()
+        self.matches = MatchTracker(self.data.test_passwords, max_rank=n_samples)
+        # Models keeping unique guesses (e.g. PassFlow's gs strategy) get a global index of the rows generated so far,
+        # self.seen, instead of keeping their guesses in memory. With `seen_set: bloom` in the eval section of the
+        # config file, it is backed by a Bloom filter and sorted runs on disk.
+        self.seen = None
+        if self.keep_uniques:
+            self.seen = create_seen_set(self.data.max_length, self.params['eval'].get('seen_set', 'memory'),
+                                        os.path.join(self.path_to_results_dir, 'seen_set'), n_samples,
+                                        float(self.params['eval'].get('seen_set_error_rate', 0.01)))
+        n_buffered = 0
+        writer = AsyncWriter()
+
+        # Every `checkpoint_every` batches the evaluation state is saved, so that an interrupted run can be resumed
+        # (with --overwrite 0) from the last checkpoint.
+        checkpoint_every = 0 if validation_mode else int(self.params['eval'].get('eval_checkpoint_frequency', 1000))
+        # A checkpoint is only resumed by the same run: same model weights, sampling settings and outputs.
+        path_to_model = os.path.join(self.path_to_checkpoint_dir, str(self.checkpoint_name))
+        run_settings = {'n_samples': n_samples, 'n_batches': n_batches, 'evaluation_batch_size': evaluation_batch_size,
+                        'save_guesses': save_guesses, 'checkpoint': self.checkpoint_name,
+                        'checkpoint_mtime': os.path.getmtime(path_to_model) if os.path.isfile(path_to_model) else None,
+                        'sampling_workers': int(self.params['eval'].get('sampling_workers', 0)),
+                        'sampling_seed': int(self.params['eval'].get('sampling_seed', 0))}
+        start_batch = 0
+        if checkpoint_every and not self.overwrite:
+            start_batch = self.load_eval_checkpoint(run_settings, eval_dict)
+            n_buffered = sum(len(guesses) for guesses in self.guesses)
+        if start_batch == 0 and not validation_mode:
+            # The evaluation starts from scratch: a checkpoint that was not resumed and the outputs it kept are removed,
+            # so that no new guess is appended to a stale guesses file.
+            self._clean_outputs()
+            if self.seen is not None:
+                self.seen.clear()
+
+        progress_bar = tqdm(range(n_batches), initial=start_batch)
+        progress_bar.set_description(desc='Generating sample batch')
 
-        for batch in range(n_batches):
+        for batch in range(start_batch, n_batches):
             generated_passwords = self.sample(evaluation_batch_size, eval_dict)
+            if isinstance(generated_passwords, np.ndarray):
+                # Rows that can not be decoded are never written, so they are dropped here to keep the match ranks
+                # aligned with the lines of the guesses file.
+                generated_passwords = unique_rows(generated_passwords)
+                generated_passwords = generated_passwords[self.data.valid_rows(generated_passwords)]
 
-            self.guesses.extend(generated_passwords)
-            self.matches.update(generated_passwords & self.data.test_passwords)
+            self.matches.update(generated_passwords)
+            if self.seen is not None:
+                self.seen.add(generated_passwords)
+
+            if save_guesses:
+                self.guesses.append(generated_passwords)
+                n_buffered += len(generated_passwords)
 
             self.guessing_strategy(evaluation_batch_size, eval_dict)
 
-            if save_guesses and len(self.guesses) >= save_every:
-                if not self.keep_uniques:
-                    self.write_to_file(self.path_to_guesses_file, self.guesses)
-                    self.guesses = []
+            checkpoint = checkpoint_every and (batch + 1) % checkpoint_every == 0 and batch + 1 < n_batches
+            if save_guesses and (n_buffered >= save_every or checkpoint):
+                writer.submit(self.write_guesses, self.guesses)
+                self.guesses = []
+                n_buffered = 0
+
+            if checkpoint:
+                writer.wait()
+                self.save_eval_checkpoint(batch + 1, run_settings, eval_dict)
 
             progress_bar.set_postfix({'Matches found': {len(self.matches)},
                                       'Test set %': ({len(self.matches) / len(self.data.test_passwords) * 100.0})})
@@ -354,18 +601,84 @@ class Model:
 
         self.post_sampling(eval_dict)
 
-        if save_guesses and len(self.guesses) > 0:
-            self.write_to_file(self.path_to_guesses_file, self.guesses)
+        if save_guesses and n_buffered > 0:
+            writer.submit(self.write_guesses, self.guesses)
+        self.guesses = []
+        if self.seen is not None:
+            self.seen.close()
+            self.seen = None
 
         if save_matches:
-            self.write_to_file(self.path_to_matches_file, self.matches)
+            writer.submit(self.write_to_file, self.path_to_matches_file, self.matches.matched_passwords())
+        writer.close()
 
         n_matches = len(self.matches)
         test_size = len(self.data.test_passwords)
+
+        if save_guesses and self._matches_text_index():
+            ranks_file = get_ranks_path(self.path_to_guesses_file, self.path_to_test_dataset)
+            save_ranks(ranks_file, self.matches.hit_ranks(), self.matches.n_guesses, test_size)
+
+        if checkpoint_every and os.path.isfile(self.path_to_eval_checkpoint):
+            os.remove(self.path_to_eval_checkpoint)
         match_percentage = f'{(n_matches / test_size) * 100:.2f}%'
         print(f'{n_matches} matches found ({match_percentage} of test set).')
         return n_matches, match_percentage, test_size
 
+    def save_eval_checkpoint(self, next_batch, run_settings, eval_dict):
+        state = {
+            'settings': run_settings,
+            'next_batch': next_batch,
+            'rng': get_rng_states(),
+            'matches': self.matches.state_dict(),
+            'guesses': self.guesses,
+            'seen': self.seen.state_dict() if self.seen is not None else None,
+            'guesses_file': get_file_state(self.path_to_guesses_file) if run_settings['save_guesses'] else None,
+            'strategy': self.get_eval_state(eval_dict),
+        }
+
+        tmp_path = f"{self.path_to_eval_checkpoint}.tmp"
+        torch.save(state, tmp_path)
+        os.replace(tmp_path, self.path_to_eval_checkpoint)
+
+    def load_eval_checkpoint(self, run_settings, eval_dict):
+        if not os.path.isfile(self.path_to_eval_checkpoint):
+            return 0
+
+        state = torch.load(self.path_to_eval_checkpoint, weights_only=False)
+        if state['settings'] != run_settings:
+            print(f"[I] - Evaluation checkpoint saved with different settings ({state['settings']}). Ignoring it.")
+            return 0
+
+        if state['guesses_file'] is not None:
+            restore_file_state(self.path_to_guesses_file, state['guesses_file'])
+        self.matches.load_state_dict(state['matches'])
+        self.guesses = state['guesses']
+        if self.seen is not None and state.get('seen') is not None:
+            self.seen.load_state_dict(state['seen'])
+        self.set_eval_state(eval_dict, state['strategy'])
+        set_rng_states(state['rng'])
+
+        print(f"[I] - Resuming evaluation from batch {state['next_batch']} ({len(self.matches)} matches so far).")
+        return state['next_batch']
+
+    def get_eval_state(self, eval_dict):
+        """
+        Override this method if your guessing strategy keeps a state across batches (e.g. PassFlow's matched_history),
+        so that it is saved in the evaluation checkpoints.
+
+        Returns:
+            - state: Any object that torch.save can serialize. It is given back to set_eval_state on resume.
+        """
+        return None
+
+    def set_eval_state(self, eval_dict, state):
+        """
+        Override this method together with get_eval_state, to restore the state of your guessing strategy into the
+        eval_dict returned by `self.eval_init` when an evaluation is resumed.
+        """
+        pass
+
     def eval_init(self, n_samples, evaluation_batch_size):
         """
         **TO BE IMPLEMENTED BY SUBCLASS.**
@@ -399,8 +712,9 @@ class Model:
             - evaluation_batch_size (int): Number of passwords to generate in this batch.
             - eval_dict (dict): Dictionary returned in `self.eval_init`.
         Returns:
-            - generated_passwords (list): A list of generated passwords, matching the format of the test passwords defined in
-             prepare_data.
+            - generated_passwords (np.ndarray or set): Either a uint8 array of shape (evaluation_batch_size, max_length)
+             containing encoded passwords, or a set of generated passwords, matching the format of the test passwords
+             defined in prepare_data.
         """
         raise NotImplementedError('This method should be implemented in the subclass.')
 
@@ -441,12 +755,58 @@ class Model:
         raise NotImplementedError('This method should be implemented in the subclass.')
 
 
+def get_rng_states():
+    states = {
+        'python': random.getstate(),
+        'numpy': np.random.get_state(),
+        'torch': torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        states['cuda'] = torch.cuda.get_rng_state_all()
+    return states
+
+
+def set_rng_states(states):
+    random.setstate(states['python'])
+    np.random.set_state(states['numpy'])
+    torch.set_rng_state(states['torch'])
+    if 'cuda' in states and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(states['cuda'])
+
+
 def read_dataset(path):
     with open(path, 'rb') as f:
         data = pickle.load(f)
     data = data.split("\n")
     return data
 
+
+class LazySplit(Sequence):
+    """
+    Passwords of a dataset split, read with read_dataset the first time they are used. E.g. Dataset never reads them
+    when the encoded split is already cached.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._passwords = None
+
+    @property
+    def passwords(self):
+        if self._passwords is None:
+            print(f"[I] - Reading {self.path}.")
+            self._passwords = read_dataset(self.path)
+        return self._passwords
+
+    def __len__(self):
+        return len(self.passwords)
+
+    def __getitem__(self, index):
+        return self.passwords[index]
+
+    def __iter__(self):
+        return iter(self.passwords)
+
 def get_checkpoint_id(path):
     next_id = 1
     checkpoints = []
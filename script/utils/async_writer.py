@@ -0,0 +1,51 @@
+import queue
+import threading
+
+
+class AsyncWriter:
+    """
+    Runs write jobs in a background thread, so that sampling the next batches overlaps with the decoding and the
+    compression of the previous ones (zlib releases the GIL while compressing).
+
+    At most `max_pending` jobs wait in the queue: submit blocks when it is full, which bounds the memory held by
+    pending guesses. close() waits for every submitted job and raises the first error hit by the writer, if any.
+    """
+
+    def __init__(self, max_pending=2):
+        self.jobs = queue.Queue(maxsize=max_pending)
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                self.jobs.task_done()
+                break
+
+            function, args = job
+            if self.error is None:  # after an error, jobs are only drained so that submit never blocks forever
+                try:
+                    function(*args)
+                except BaseException as e:
+                    self.error = e
+            self.jobs.task_done()
+
+    def _raise_error(self):
+        if self.error is not None:
+            raise self.error
+
+    def submit(self, function, *args):
+        self._raise_error()
+        self.jobs.put((function, args))
+
+    def wait(self):
+        # Waits until every submitted job has been written.
+        self.jobs.join()
+        self._raise_error()
+
+    def close(self):
+        self.jobs.put(None)
+        self.thread.join()
+        self._raise_error()
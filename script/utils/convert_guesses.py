@@ -0,0 +1,101 @@
+import argparse
+import os
+import sys
+
+import numpy as np
+
+sys.path.append(os.getcwd())
+
+from script.utils.file_operations import load_guesses_chunk
+from script.utils.guesses_io import iter_guesses_bin, write_guesses, write_guesses_bin
+
+"""
+Script used to convert guesses files between the text format (.gz) and the binary format (.bin).
+
+    python script/utils/convert_guesses.py --input results/.../guesses/guesses.gz --output guesses.bin
+    python script/utils/convert_guesses.py --input results/.../guesses/guesses.bin --output guesses.gz
+
+When converting to .bin, the charmap is built from the characters found in the input file and passwords are padded
+with '`', like in script/dataset/dataset.py. As for the models trained on that charmap, '`' characters are therefore
+removed when the passwords are decoded.
+"""
+
+PADDING = '`'
+CHUNK_SIZE = 65536
+
+
+def bin_to_gz(file_in, file_out):
+    write_guesses(file_out, (password for chunk in iter_guesses_bin(file_in, CHUNK_SIZE) for password in chunk))
+
+
+def gz_to_bin(file_in, file_out, max_length=None):
+    # First pass: charmap and max_length.
+    chars = {PADDING}
+    longest = 0
+    for chunk in load_guesses_chunk(file_in, CHUNK_SIZE):
+        chars.update(*chunk)
+        longest = max([longest] + [len(password) for password in chunk])
+
+    if len(chars) > 256:
+        raise ValueError(f"{file_in} contains {len(chars)} different characters, at most 256 can be stored.")
+
+    max_length = int(max_length or longest)
+    inv_charmap = sorted(chars)
+    codes = np.array([ord(char) for char in inv_charmap], dtype=np.uint32)
+
+    # Second pass: passwords are encoded as charmap indices, unicode code points are mapped through a binary search
+    # over the sorted charmap.
+    skipped = 0
+    for chunk in load_guesses_chunk(file_in, CHUNK_SIZE):
+        too_long = [len(password) > max_length for password in chunk]
+        if any(too_long):
+            skipped += sum(too_long)
+            chunk = [password for password, skip in zip(chunk, too_long) if not skip]
+
+        chunk_codes = np.array(chunk, dtype=f'U{max_length}').view(np.uint32).reshape(len(chunk), max_length)
+        chunk_codes = np.where(chunk_codes == 0, ord(PADDING), chunk_codes)
+        write_guesses_bin(file_out, np.searchsorted(codes, chunk_codes).astype(np.uint8), inv_charmap, PADDING)
+
+    if skipped:
+        print(f"[W] - {skipped} passwords longer than {max_length} characters were skipped.")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--input',
+                        required=True,
+                        help='Guesses file to convert (.gz or .bin)')
+
+    parser.add_argument('--output',
+                        required=True,
+                        help='Converted guesses file (.bin or .gz)')
+
+    parser.add_argument('--max_length',
+                        type=int,
+                        default=None,
+                        help='Width of the binary rows. Default: length of the longest password')
+
+    args = parser.parse_args()
+    return args
+
+
+def main(file_in, file_out, max_length=None):
+    print(f"[I] - Converting {file_in} to {file_out}")
+
+    if os.path.exists(file_out):
+        raise FileExistsError(f"{file_out} already exists.")
+
+    if file_in.endswith('.gz') and file_out.endswith('.bin'):
+        gz_to_bin(file_in, file_out, max_length)
+    elif file_in.endswith('.bin') and file_out.endswith('.gz'):
+        bin_to_gz(file_in, file_out)
+    else:
+        raise ValueError("Conversions are only supported from .gz to .bin and from .bin to .gz.")
+
+    print("[I] - Done")
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    main(args.input, args.output, args.max_length)
@@ -1,8 +1,10 @@
 import os
-import gzip
+import numpy as np
 
-from script.utils.file_operations import load_pickle
 from script.utils.file_operations import load_guesses_chunk
+from script.utils.guesses_io import copy_guesses_head, iter_guesses_bin
+from script.utils.password_index import load_test_index
+from script.utils.match_tracker import MatchTracker
 
 
 def check_skip_generation(path):
@@ -21,45 +23,76 @@ def sub_sample(file_in, thresholds):
         file_out = os.path.join(*tmp_out)
         os.makedirs(os.path.dirname(file_out), exist_ok=True)
 
-        with gzip.open(file_out, 'wt') as f_out:
-            with gzip.open(file_in, 'rt') as f_in:
-                for i, line in enumerate(f_in):
-                    f_out.write(line)
-                    if i >= n_samples - 1:
-                        break
+        copy_guesses_head(file_in, file_out, n_samples)
         print(f'[I] - Done!')
 
 
-def fast_eval(test_file, thresholds, guesses_file):
-    print(f'[I] - Starting fast eval mode. :)')
-    print(f'[I] - Guesses file: {guesses_file}')
-    print(f'[I] - Test file: {test_file}')
+def get_ranks_path(guesses_file, test_file):
+    # e.g. guesses.gz evaluated on test-<hash>.pickle -> guesses.gz.test-<hash>.ranks.npz
+    test_name = os.path.splitext(os.path.basename(test_file))[0]
+    return f'{guesses_file}.{test_name}.ranks.npz'
+
+
+def save_ranks(path, hit_ranks, n_guesses, test_size, complete=True):
+    # `complete` tells whether n_guesses is the total number of guesses in the file, or the file has only been read
+    # up to n_guesses.
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, hit_ranks=hit_ranks, n_guesses=n_guesses, test_size=test_size, complete=complete)
+    os.replace(tmp_path, path)
+
+
+def load_ranks(path):
+    with np.load(path) as ranks:
+        return ranks['hit_ranks'], int(ranks['n_guesses']), int(ranks['test_size']), bool(ranks['complete'])
+
 
+def evaluate_thresholds(hit_ranks, n_guesses, test_size, thresholds):
     output = []
 
-    total_passwords = 0
-    test_passwords = set(load_pickle(test_file).split("\n"))
+    n_matches = np.searchsorted(hit_ranks, np.asarray(thresholds, dtype=np.uint64), side='right')
+    for threshold, total_matches in zip(thresholds, n_matches.tolist()):
+        if threshold > n_guesses:
+            continue
+        match_percentage = f'{(total_matches / test_size) * 100:.2f}%'
+        print(f'[{threshold}] - {total_matches} matches found ({match_percentage} of test set).')
+        output.append([test_size, threshold, total_matches, match_percentage])
 
-    matches = set()
+    return output
+
+
+def fast_eval(test_file, thresholds, guesses_file):
+    print(f'[I] - Starting fast eval mode. :)')
+    print(f'[I] - Guesses file: {guesses_file}')
+    print(f'[I] - Test file: {test_file}')
 
-    for chunk in load_guesses_chunk(guesses_file):
-        total_passwords += len(chunk)
+    thresholds = sorted(thresholds)
 
-        guesses_set = set(chunk)
+    # First-hit ranks are computed once per (guesses file, test set), any later threshold is answered from them. Ranks
+    # counted against another index of the test set (e.g. a Dataset's one) are not reused.
+    test_passwords = load_test_index(test_file)
+    ranks_file = get_ranks_path(guesses_file, test_file)
+    if os.path.isfile(ranks_file) and os.path.getmtime(ranks_file) >= os.path.getmtime(guesses_file):
+        hit_ranks, n_guesses, test_size, complete = load_ranks(ranks_file)
+        if test_size == len(test_passwords) and (complete or thresholds[-1] <= n_guesses):
+            print(f'[I] - Using first-hit ranks from {ranks_file}')
+            return evaluate_thresholds(hit_ranks, n_guesses, test_size, thresholds)
 
-        current_match = guesses_set & test_passwords
+    matches = MatchTracker(test_passwords)
 
-        matches.update(current_match)
+    if guesses_file.endswith('.bin'):
+        chunks = iter_guesses_bin(guesses_file, chunk_size=65536, as_rows=True)
+    else:
+        chunks = load_guesses_chunk(guesses_file, chunk_size=65536)
 
-        if total_passwords >= thresholds[0]:
-            total_matches = len(matches)
-            test_size = len(test_passwords)
-            match_percentage = f'{(total_matches / len(test_passwords)) * 100:.2f}%'
-            print(f'[{thresholds[0]}] - {total_matches} matches found ({match_percentage} of test set).')
-            output.append([test_size, thresholds[0], total_matches, match_percentage])
-            thresholds.pop(0)
+    complete = True
+    for chunk in chunks:
+        matches.update(chunk)
 
-        if len(thresholds) == 0:
+        if matches.n_guesses >= thresholds[-1]:
+            complete = False
             break
 
-    return output
+    hit_ranks = matches.hit_ranks()
+    save_ranks(ranks_file, hit_ranks, matches.n_guesses, len(test_passwords), complete)
+    return evaluate_thresholds(hit_ranks, matches.n_guesses, len(test_passwords), thresholds)
@@ -7,7 +7,8 @@ import pickle
 import gdown
 import sys
 import csv
-import gzip
+
+from script.utils.guesses_io import iter_guesses_blocks, iter_guesses_bin, read_guesses_text, write_guesses
 
 
 def extract_zip(zip_file, output_path):
@@ -134,15 +135,14 @@ def save_pickle(output_file, lines):
 
 
 def load_guesses_chunk(path, chunk_size=2048):
-    with gzip.open(path, "rt") as file:
-        chunk = []
-        for line in file:
-            chunk.append(line.strip())
-            if len(chunk) >= chunk_size:
-                yield chunk
-                chunk = []
-        if chunk:
-            yield chunk
+    if path.endswith('.bin'):
+        yield from iter_guesses_bin(path, chunk_size)
+        return
+
+    # Blocks of the guesses file are decompressed in parallel, see script/utils/guesses_io.py
+    for block in iter_guesses_blocks(path):
+        for i in range(0, len(block), chunk_size):
+            yield block[i:i + chunk_size]
 
 
 def load_pickle(path):
@@ -198,10 +198,7 @@ def save_split(passwords, path):
 
 
 def write_passwords_to_file(file_name, passwords):
-    with gzip.open(file_name, 'at') as f:
-        for password in passwords:
-            result_string = ''.join(map(str, password))
-            f.write(result_string + '\n')
+    write_guesses(file_name, (''.join(map(str, password)) for password in passwords))
 
 
 def write_to_csv(path, fieldnames, fixed_data, variable_data):
@@ -222,8 +219,10 @@ def write_to_csv(path, fieldnames, fixed_data, variable_data):
 
 def read_files(path):
     if path.endswith('.gz'):
-        with gzip.open(path, 'rt') as f:
-            data = f.read().split("\n")
+        data = read_guesses_text(path).split("\n")
+
+    elif path.endswith('.bin'):
+        data = [password for chunk in iter_guesses_bin(path) for password in chunk]
 
     elif path.endswith('.txt'):
         with open(path, 'r') as f:
@@ -0,0 +1,347 @@
+import os
+import gzip
+import json
+import itertools
+import struct
+import multiprocessing
+import collections
+import numpy as np
+
+# Guesses files are a sequence of independently compressed gzip members (blocks), which is still a valid .gz file for
+# any gzip reader. A small manifest next to the file (guesses.gz -> guesses.manifest.json) stores, for each block, its
+# byte offset, compressed size and number of lines, so blocks can be decompressed in parallel or copied as they are.
+
+BLOCK_SIZE = 1000000
+# Blocks are decompressed by at most MAX_PROCESSES processes, each block being about 1M decoded strings.
+MAX_PROCESSES = 4
+
+
+def get_manifest_path(path):
+    return os.path.splitext(path)[0] + '.manifest.json'
+
+
+def read_manifest(path):
+    manifest_path = get_manifest_path(path)
+    if not os.path.isfile(manifest_path) or not os.path.isfile(path):
+        return None
+
+    with open(manifest_path, 'r') as f:
+        blocks = json.load(f)['blocks']
+
+    # The manifest does not describe the file anymore (e.g. the run was killed between the two writes), the file is
+    # then read as a single stream.
+    if (blocks[-1][0] + blocks[-1][1] if blocks else 0) != os.path.getsize(path):
+        return None
+    return blocks
+
+
+def _write_manifest(path, blocks):
+    manifest_path = get_manifest_path(path)
+    tmp_path = f'{manifest_path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump({'blocks': blocks}, f)
+    os.replace(tmp_path, manifest_path)
+
+
+def append_raw_blocks(path, raw_blocks):
+    # raw_blocks: list of (compressed bytes, number of lines).
+    blocks = read_manifest(path)
+    if blocks is None:
+        blocks = []
+        if os.path.isfile(path) and os.path.getsize(path) > 0:
+            # Legacy single stream, kept as one block whose number of lines is unknown.
+            blocks.append([0, os.path.getsize(path), None])
+
+    with open(path, 'ab') as f:
+        offset = f.tell()
+        for data, n_lines in raw_blocks:
+            f.write(data)
+            blocks.append([offset, len(data), n_lines])
+            offset += len(data)
+
+    _write_manifest(path, blocks)
+
+
+def get_file_state(path):
+    # Size and blocks of a guesses file (.gz or .bin), used to bring the file back to this point with restore_file_state.
+    if not os.path.isfile(path):
+        return {'size': 0, 'blocks': None}
+    return {'size': os.path.getsize(path), 'blocks': read_manifest(path)}
+
+
+def restore_file_state(path, state):
+    # Drops everything written to the file after get_file_state was called.
+    if state['size'] == 0:
+        for file in (path, get_manifest_path(path)):
+            if os.path.isfile(file):
+                os.remove(file)
+        return
+
+    with open(path, 'r+b') as f:
+        f.truncate(state['size'])
+
+    if state['blocks'] is not None:
+        _write_manifest(path, state['blocks'])
+
+
+def write_guesses(path, passwords, block_size=BLOCK_SIZE):
+    """
+    Appends passwords (strings) to a guesses file, one line each, compressing every `block_size` lines as a block.
+    """
+    block = []
+    for password in passwords:
+        block.append(password)
+        if len(block) >= block_size:
+            append_raw_blocks(path, [_compress_block(block)])
+            block = []
+    if block:
+        append_raw_blocks(path, [_compress_block(block)])
+
+
+def _compress_block(lines):
+    return gzip.compress(('\n'.join(lines) + '\n').encode('utf-8')), len(lines)
+
+
+def _read_raw_block(args):
+    path, offset, length = args
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        return f.read(length)
+
+
+def _read_block_text(args):
+    return gzip.decompress(_read_raw_block(args)).decode('utf-8')
+
+
+def _read_block_lines(args):
+    lines = _read_block_text(args).split('\n')
+    if lines and lines[-1] == '':
+        lines.pop()
+    return [line.strip() for line in lines]
+
+
+class _FileRegion:
+    # Read-only file object over `length` bytes of f, starting at `offset`.
+    def __init__(self, f, offset, length):
+        f.seek(offset)
+        self.f = f
+        self.remaining = length
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.f.read(size)
+        self.remaining -= len(data)
+        return data
+
+
+def _iter_region_lines(path, offset, length):
+    # Streams the lines of a block whose number of lines is unknown (a legacy single stream), which can be arbitrarily
+    # large.
+    with open(path, 'rb') as f, gzip.open(_FileRegion(f, offset, length), 'rt', encoding='utf-8') as text:
+        for line in text:
+            yield line.strip()
+
+
+def _batch_lines(lines):
+    block = []
+    for line in lines:
+        block.append(line)
+        if len(block) >= BLOCK_SIZE:
+            yield block
+            block = []
+    if block:
+        yield block
+
+
+def _map_blocks(function, path, blocks, processes):
+    tasks = [(path, offset, length) for offset, length, _ in blocks]
+    if processes is None:
+        processes = min(os.cpu_count() or 1, MAX_PROCESSES)
+
+    # Daemonic processes (e.g. pool workers) can not have children.
+    if processes <= 1 or len(tasks) <= 1 or multiprocessing.current_process().daemon:
+        yield from map(function, tasks)
+        return
+
+    # At most `processes` blocks are decompressed ahead of the one being consumed.
+    with multiprocessing.Pool(min(processes, len(tasks))) as pool:
+        pending = collections.deque()
+        for task in tasks:
+            if len(pending) >= processes:
+                yield pending.popleft().get()
+            pending.append(pool.apply_async(function, (task,)))
+        while pending:
+            yield pending.popleft().get()
+
+
+def iter_guesses_blocks(path, processes=None):
+    """
+    Yields the lines of a guesses file block by block, decompressing blocks in a process pool when a manifest is
+    available. Lines are stripped, as in load_guesses_chunk.
+    """
+    blocks = read_manifest(path)
+    if blocks is None:
+        with gzip.open(path, 'rt') as f:
+            yield from _batch_lines(line.strip() for line in f)
+        return
+
+    for legacy, group in itertools.groupby(blocks, key=lambda block: block[2] is None):
+        if legacy:
+            for offset, length, _ in group:
+                yield from _batch_lines(_iter_region_lines(path, offset, length))
+        else:
+            yield from _map_blocks(_read_block_lines, path, list(group), processes)
+
+
+def read_guesses_text(path, processes=None):
+    blocks = read_manifest(path)
+    if blocks is None:
+        with gzip.open(path, 'rt') as f:
+            return f.read()
+
+    text = []
+    for legacy, group in itertools.groupby(blocks, key=lambda block: block[2] is None):
+        if legacy:
+            for offset, length, _ in group:
+                with open(path, 'rb') as f, gzip.open(_FileRegion(f, offset, length), 'rt', encoding='utf-8') as f_in:
+                    text.append(f_in.read())
+        else:
+            text.extend(_map_blocks(_read_block_text, path, list(group), processes))
+    return ''.join(text)
+
+
+def copy_guesses_head(file_in, file_out, n_lines):
+    """
+    Writes the first `n_lines` lines of file_in to file_out. Whole blocks are copied without being decompressed, only
+    the block containing the cut is re-compressed.
+    """
+    for path in (file_out, get_manifest_path(file_out)):
+        if os.path.isfile(path):
+            os.remove(path)
+
+    if file_in.endswith('.bin'):
+        rows, header = read_guesses_bin(file_in)
+        write_guesses_bin(file_out, rows[:n_lines], header['charmap'], header['padding'])
+        return
+
+    blocks = read_manifest(file_in)
+    if blocks is None or any(block[2] is None for block in blocks):
+        with gzip.open(file_in, 'rt') as f_in:
+            write_guesses(file_out, (line.rstrip('\n') for line in itertools.islice(f_in, n_lines)))
+        return
+
+    remaining = n_lines
+    for offset, length, block_lines in blocks:
+        if remaining <= 0:
+            break
+        if block_lines <= remaining:
+            append_raw_blocks(file_out, [(_read_raw_block((file_in, offset, length)), block_lines)])
+        else:
+            lines = _read_block_text((file_in, offset, length)).split('\n')[:remaining]
+            append_raw_blocks(file_out, [_compress_block(lines)])
+        remaining -= block_lines
+
+
+# Binary guesses files (.bin), for models generating fixed-width encoded passwords: a header holding the charmap and
+# max_length, followed by the raw uint8 rows. The rows are read back as a single memory-mapped array.
+
+BIN_MAGIC = b'MAYAGUES'
+
+
+def write_guesses_bin(path, rows, inv_charmap, padding='`'):
+    rows = np.ascontiguousarray(rows, dtype=np.uint8)
+    header = {'max_length': rows.shape[1], 'charmap': list(inv_charmap), 'padding': padding}
+
+    if not os.path.isfile(path) or os.path.getsize(path) == 0:
+        data = json.dumps(header).encode('utf-8')
+        with open(path, 'wb') as f:
+            f.write(BIN_MAGIC + struct.pack('<I', len(data)) + data)
+    else:
+        existing, _ = _read_bin_header(path)
+        if existing != header:
+            raise ValueError(f"Can not append to {path}: its header ({existing}) does not match the rows ({header}).")
+
+    with open(path, 'ab') as f:
+        f.write(rows.tobytes())
+
+
+def _read_bin_header(path):
+    # Returns the header of a binary guesses file and the offset of its first row.
+    with open(path, 'rb') as f:
+        if f.read(len(BIN_MAGIC)) != BIN_MAGIC:
+            raise ValueError(f"{path} is not a binary guesses file.")
+        header_size = struct.unpack('<I', f.read(4))[0]
+        header = json.loads(f.read(header_size).decode('utf-8'))
+    return header, len(BIN_MAGIC) + 4 + header_size
+
+
+def read_guesses_bin(path):
+    header, offset = _read_bin_header(path)
+    width = header['max_length']
+    n_rows = (os.path.getsize(path) - offset) // width
+    if n_rows == 0:
+        return np.zeros((0, width), dtype=np.uint8), header
+    return np.memmap(path, dtype=np.uint8, mode='r', offset=offset, shape=(n_rows, width)), header
+
+
+def drop_zeros(codes):
+    # Moves the zeros of each row to its end, keeping the order of the other values.
+    if not np.any((codes[:, :-1] == 0) & (codes[:, 1:] != 0)):
+        return codes
+    order = np.argsort(codes == 0, axis=1, kind='stable')
+    return np.take_along_axis(codes, order, axis=1)
+
+
+def _charmap_lut(inv_charmap, padding, dtype):
+    lut = np.zeros(256, dtype=dtype)
+    lut[:len(inv_charmap)] = [ord(char) for char in inv_charmap]
+    lut[lut == ord(padding)] = 0
+    return lut
+
+
+def decode_rows(rows, inv_charmap, padding='`'):
+    """
+    Decodes a (n, max_length) array of charmap indices to strings, removing the padding character. Rows holding an
+    index outside the charmap are decoded to None.
+    """
+    rows = np.asarray(rows, dtype=np.uint8)
+    if len(rows) == 0:
+        return []
+
+    valid = np.all(rows < len(inv_charmap), axis=1)
+    codes = drop_zeros(_charmap_lut(inv_charmap, padding, np.uint32)[rows])
+    passwords = codes.view(f'U{rows.shape[1]}').ravel().tolist()
+
+    if not valid.all():
+        passwords = [password if is_valid else None for password, is_valid in zip(passwords, valid.tolist())]
+    return passwords
+
+
+def utf8_rows(rows, inv_charmap, padding='`'):
+    """
+    Same as decode_rows, but returns the utf-8 bytes of the passwords as zero-padded uint8 rows (the format of a
+    TextPasswordIndex) without building any string. Only available for ASCII charmaps, returns None otherwise.
+    """
+    if any(ord(char) >= 128 for char in inv_charmap):
+        return None
+
+    rows = np.asarray(rows, dtype=np.uint8)
+    codes = drop_zeros(_charmap_lut(inv_charmap, padding, np.uint8)[rows])
+
+    # 0xFF is never part of valid utf-8, so rows that can not be decoded never match any password.
+    codes[~np.all(rows < len(inv_charmap), axis=1), 0] = 0xFF
+    return codes
+
+
+def iter_guesses_bin(path, chunk_size=65536, as_rows=False):
+    rows, header = read_guesses_bin(path)
+
+    for i in range(0, len(rows), chunk_size):
+        chunk = rows[i:i + chunk_size]
+        if as_rows:
+            encoded = utf8_rows(chunk, header['charmap'], header['padding'])
+            if encoded is not None:
+                yield encoded
+                continue
+        yield decode_rows(chunk, header['charmap'], header['padding'])
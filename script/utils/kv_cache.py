@@ -0,0 +1,7 @@
+def select_cache_rows(past_key_values, rows):
+    # Keeps only the given batch rows of the key/value cache of a transformers model, either in the legacy tuple format
+    # or as a Cache object.
+    if isinstance(past_key_values, tuple):
+        return tuple(tuple(tensor.index_select(0, rows) for tensor in layer) for layer in past_key_values)
+    past_key_values.reorder_cache(rows)
+    return past_key_values
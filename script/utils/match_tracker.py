@@ -0,0 +1,50 @@
+import numpy as np
+
+
+class MatchTracker:
+    """
+    Keeps track of the test passwords guessed so far, as the rank of the first guess that matched each password of a
+    PasswordIndex (0 if the password has not been guessed yet). Ranks start from 1 and follow the order in which the
+    guesses are passed to update, i.e. the line number of the guess in the guesses file.
+
+    Memory only depends on the size of the test set, no matter how many guesses are evaluated.
+    """
+
+    def __init__(self, index, max_rank=None):
+        self.index = index
+        dtype = np.uint32 if max_rank is not None and max_rank < 2 ** 32 else np.uint64
+        self.ranks = np.zeros(len(index), dtype=dtype)
+        self.n_matches = 0
+        self.n_guesses = 0
+        self.new_matches = np.empty(0, dtype=np.int64)
+
+    def __len__(self):
+        return self.n_matches
+
+    def update(self, passwords):
+        positions = self.index.lookup(passwords)
+        hits = np.flatnonzero(positions >= 0)
+        matched, first = np.unique(positions[hits], return_index=True)
+
+        new = self.ranks[matched] == 0
+        self.new_matches = matched[new]
+        self.ranks[self.new_matches] = self.n_guesses + hits[first[new]] + 1
+
+        self.n_matches += len(self.new_matches)
+        self.n_guesses += len(positions)
+        return self.new_matches
+
+    def matched_passwords(self):
+        return self.index.passwords(np.flatnonzero(self.ranks))
+
+    def hit_ranks(self):
+        # Sorted first-hit ranks: the number of matches within the first n guesses is searchsorted(hit_ranks, n).
+        return np.sort(self.ranks[self.ranks > 0]).astype(np.uint64)
+
+    def state_dict(self):
+        return {'ranks': self.ranks.copy(), 'n_matches': self.n_matches, 'n_guesses': self.n_guesses}
+
+    def load_state_dict(self, state):
+        self.ranks = state['ranks']
+        self.n_matches = state['n_matches']
+        self.n_guesses = state['n_guesses']
@@ -0,0 +1,117 @@
+import ctypes
+import traceback
+import multiprocessing
+
+import numpy as np
+import torch
+
+
+def batch_seed(seed, batch):
+    return int(np.random.SeedSequence([seed, batch]).generate_state(1, dtype=np.uint64)[0] % 2 ** 63)
+
+
+def _worker(sample_function, seed, first_batch, stride, buffer, shape, n_slots, free_slots, ready_slots):
+    # Every worker runs a single-threaded forward pass, parallelism comes from the number of workers.
+    torch.set_num_threads(1)
+
+    slots = np.frombuffer(buffer, dtype=np.uint8).reshape(n_slots, *shape)
+    batch = first_batch
+    try:
+        while True:
+            slot = free_slots.get()
+            if slot is None:
+                break
+            rng_seed = batch_seed(seed, batch)
+            torch.manual_seed(rng_seed)
+            np.random.seed(rng_seed % 2 ** 32)
+            rows = sample_function()
+            slots[slot, :len(rows)] = rows
+            ready_slots.put((slot, len(rows)))
+            batch += stride
+    except Exception:
+        ready_slots.put((None, traceback.format_exc()))
+
+
+class ParallelSampler:
+    """
+    Generates batches of encoded passwords in `n_workers` forked processes, for models whose sample step does not
+    depend on the previous batches (e.g. PassGAN, or PLRGAN without dynamic sampling).
+
+    Workers inherit the loaded model from the parent process, so the checkpoint is loaded only once. They are forked at
+    the first call to sample, worker i generating the batches i, i + n_workers, ... into `n_slots` shared memory slots,
+    which the parent reads back in round-robin order. Each batch is sampled with its own seed, derived from
+    (seed, batch index): the sequence of batches only depends on the seed, and an evaluation resumed from a checkpoint
+    (see state_dict) goes on with the batches that follow it.
+    """
+
+    def __init__(self, sample_function, n_workers, batch_shape, seed=0, n_slots=2):
+        self.sample_function = sample_function
+        self.n_workers = n_workers
+        self.batch_shape = batch_shape
+        self.seed = seed
+        self.n_slots = n_slots
+
+        self.n_batches = 0
+        self.next_worker = 0
+        self.slots = []
+        self.free_slots = []
+        self.ready_slots = []
+        self.workers = []
+
+    def _start(self):
+        context = multiprocessing.get_context('fork')
+        slot_size = self.n_slots * int(np.prod(self.batch_shape))
+
+        for worker_id in range(self.n_workers):
+            buffer = context.RawArray(ctypes.c_uint8, slot_size)
+            free_slots, ready_slots = context.Queue(), context.Queue()
+            for slot in range(self.n_slots):
+                free_slots.put(slot)
+
+            worker = context.Process(target=_worker, daemon=True,
+                                     args=(self.sample_function, self.seed, self.n_batches + worker_id, self.n_workers,
+                                           buffer, self.batch_shape, self.n_slots, free_slots, ready_slots))
+            worker.start()
+
+            self.slots.append(np.frombuffer(buffer, dtype=np.uint8).reshape(self.n_slots, *self.batch_shape))
+            self.free_slots.append(free_slots)
+            self.ready_slots.append(ready_slots)
+            self.workers.append(worker)
+        self.next_worker = 0
+
+    def sample(self):
+        if not self.workers:
+            self._start()
+
+        worker_id = self.next_worker
+        self.next_worker = (self.next_worker + 1) % self.n_workers
+
+        slot, n_rows = self.ready_slots[worker_id].get()
+        if slot is None:
+            self.close()
+            raise RuntimeError(f"Sampling worker {worker_id} failed:\n{n_rows}")
+
+        rows = self.slots[worker_id][slot, :n_rows].copy()
+        self.free_slots[worker_id].put(slot)
+        self.n_batches += 1
+        return rows
+
+    def state_dict(self):
+        return {'n_batches': self.n_batches}
+
+    def load_state_dict(self, state):
+        # Workers started before the state is loaded are restarted from the batch that follows it.
+        self.close()
+        self.n_batches = state['n_batches']
+
+    def close(self):
+        for free_slots in self.free_slots:
+            free_slots.put(None)
+        for worker in self.workers:
+            worker.join(timeout=5)
+            if worker.is_alive():
+                worker.terminate()
+        self.slots = []
+        self.free_slots = []
+        self.ready_slots = []
+        self.workers = []
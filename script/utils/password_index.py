@@ -0,0 +1,141 @@
+import os
+import numpy as np
+
+from script.utils.file_operations import change_extension, load_pickle
+
+
+def as_keys(rows):
+    # Views each fixed-width row as a single opaque item, so rows can be sorted and searched as a whole.
+    rows = np.ascontiguousarray(rows, dtype=np.uint8)
+    return rows.view(np.dtype((np.void, rows.shape[1]))).ravel()
+
+
+def unique_rows(rows):
+    rows = np.asarray(rows, dtype=np.uint8)
+    if len(rows) == 0:
+        return rows
+    keys = np.unique(as_keys(rows))
+    return keys.view(np.uint8).reshape(-1, rows.shape[1])
+
+
+def text_to_rows(passwords, width):
+    # Passwords are stored as their utf-8 bytes, right-padded with zeros. Passwords longer than `width` bytes can not
+    # be represented and are flagged as not valid.
+    passwords = [password.encode('utf-8', 'surrogatepass') for password in passwords]
+    if len(passwords) == 0:
+        return np.zeros((0, width), dtype=np.uint8), np.zeros(0, dtype=bool)
+
+    lengths = np.fromiter(map(len, passwords), dtype=np.int64, count=len(passwords))
+    rows = np.array(passwords, dtype=f'S{width}').view(np.uint8).reshape(len(passwords), width)
+    return rows, lengths <= width
+
+
+def rows_to_text(rows):
+    rows = np.ascontiguousarray(rows, dtype=np.uint8)
+    if len(rows) == 0:
+        return []
+    return [password.decode('utf-8', 'surrogatepass') for password in rows.view(f'S{rows.shape[1]}').ravel().tolist()]
+
+
+class PasswordIndex:
+    """
+    Compact set of passwords stored as a sorted array of unique fixed-width uint8 rows.
+
+    Membership queries are answered for a whole batch at once with a binary search, and every password of the test
+    set is identified by its position in the sorted array.
+    """
+
+    def __init__(self, rows):
+        # rows must already be sorted and unique, use from_rows otherwise.
+        self.rows = rows
+        self.width = rows.shape[1]
+
+    @classmethod
+    def from_rows(cls, rows, width):
+        rows = np.asarray(rows, dtype=np.uint8).reshape(-1, width)
+        return cls(unique_rows(rows))
+
+    @classmethod
+    def load(cls, path):
+        # The index is memory-mapped, so it is loaded in constant time and its pages are shared by every process
+        # reading the same file.
+        return cls(np.load(path, mmap_mode='r'))
+
+    def save(self, path):
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.save(f, np.ascontiguousarray(self.rows))
+        os.replace(tmp_path, path)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __contains__(self, password):
+        return bool(self.lookup([password])[0] >= 0)
+
+    def encode(self, passwords):
+        if isinstance(passwords, np.ndarray):
+            rows = passwords.astype(np.uint8, copy=False).reshape(-1, self.width)
+        else:
+            passwords = list(passwords)
+            if len(passwords) and isinstance(passwords[0], bytes):
+                rows = np.frombuffer(b''.join(passwords), dtype=np.uint8).reshape(-1, self.width)
+            else:
+                rows = np.array(passwords, dtype=np.uint8).reshape(-1, self.width)
+        return rows, np.ones(len(rows), dtype=bool)
+
+    def lookup(self, passwords):
+        rows, valid = self.encode(passwords)
+        if len(self.rows) == 0 or len(rows) == 0:
+            return np.full(len(rows), -1, dtype=np.int64)
+
+        positions = np.searchsorted(as_keys(self.rows), as_keys(rows))
+        positions[positions == len(self.rows)] = 0
+
+        found = valid & np.all(self.rows[positions] == rows, axis=1)
+        return np.where(found, positions, -1).astype(np.int64)
+
+    def passwords(self, positions):
+        return self.rows[positions]
+
+
+class TextPasswordIndex(PasswordIndex):
+    """
+    PasswordIndex for models that compare plain strings.
+    """
+
+    @classmethod
+    def from_passwords(cls, passwords, width=None):
+        passwords = set(passwords)
+        if width is None:
+            width = max([len(password.encode('utf-8', 'surrogatepass')) for password in passwords] + [1])
+
+        rows, valid = text_to_rows(passwords, width)
+        return cls(unique_rows(rows[valid]))
+
+    def encode(self, passwords):
+        if isinstance(passwords, np.ndarray):
+            # Passwords already encoded as zero-padded utf-8 rows, possibly of a different width.
+            rows = np.zeros((len(passwords), self.width), dtype=np.uint8)
+            n = min(self.width, passwords.shape[1])
+            rows[:, :n] = passwords[:, :n]
+            return rows, ~np.any(passwords[:, self.width:], axis=1)
+        return text_to_rows(passwords, self.width)
+
+    def passwords(self, positions):
+        return rows_to_text(self.rows[positions])
+
+
+def load_test_index(test_file):
+    """
+    Returns the TextPasswordIndex of a test split (data/splitted/test-<hash>.pickle).
+
+    The index is built once and stored next to the split as test-<hash>.index.npy, every later call memory-maps it.
+    """
+    index_file = change_extension(test_file, 'index.npy')
+    if os.path.isfile(index_file) and os.path.getmtime(index_file) >= os.path.getmtime(test_file):
+        return TextPasswordIndex.load(index_file)
+
+    print(f'[I] - Building test set index {index_file}.')
+    TextPasswordIndex.from_passwords(load_pickle(test_file).split("\n")).save(index_file)
+    return TextPasswordIndex.load(index_file)
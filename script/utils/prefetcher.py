@@ -0,0 +1,87 @@
+import os
+import queue
+import threading
+import weakref
+
+# Live prefetchers. Before a fork (e.g. a background validation), every prefetcher thread is paused between two batches,
+# so that the child process never inherits a batch being assembled (and the locks held meanwhile).
+_prefetchers = weakref.WeakSet()
+_paused = []
+
+
+def _pause_all():
+    for prefetcher in list(_prefetchers):
+        prefetcher.busy.acquire()
+        _paused.append(prefetcher)
+
+
+def _resume_all():
+    while _paused:
+        _paused.pop().busy.release()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(before=_pause_all, after_in_parent=_resume_all, after_in_child=_resume_all)
+
+
+class Prefetcher:
+    """
+    Iterates over `batches` in a background thread, so that the next batches are assembled while the current one is
+    used for training.
+
+    At most `size` batches wait in the queue. Iterating raises the error hit by the thread, if any. close() (also
+    called when the iteration ends or is interrupted, e.g. by a break) stops the thread.
+    """
+
+    _END = object()
+
+    def __init__(self, batches, size=2):
+        self.batches = batches
+        self.queue = queue.Queue(maxsize=max(int(size), 1))
+        self.stop = threading.Event()
+        self.busy = threading.Lock()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        _prefetchers.add(self)
+        self.thread.start()
+
+    def _put(self, item):
+        # The consumer may stop iterating at any time, so the thread never blocks on a full queue for good.
+        while not self.stop.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _run(self):
+        iterator = iter(self.batches)
+        while True:
+            try:
+                with self.busy:
+                    batch = next(iterator)
+            except StopIteration:
+                break
+            except BaseException as e:
+                self._put(e)
+                return
+            if not self._put(batch):
+                return
+        self._put(self._END)
+
+    def __iter__(self):
+        try:
+            while True:
+                item = self.queue.get()
+                if item is self._END:
+                    return
+                if isinstance(item, BaseException):
+                    raise item
+                yield item
+        finally:
+            self.close()
+
+    def close(self):
+        self.stop.set()
+        self.thread.join()
+        _prefetchers.discard(self)
@@ -0,0 +1,302 @@
+import os
+import math
+import shutil
+import numpy as np
+
+from script.utils.password_index import as_keys
+
+FNV_OFFSET = np.uint64(0xcbf29ce484222325)
+FNV_PRIME = np.uint64(0x100000001b3)
+
+
+def hash_rows(rows):
+    # 64 bit FNV-1a hash of each fixed-width uint8 row, computed column by column for the whole batch.
+    hashes = np.full(len(rows), FNV_OFFSET, dtype=np.uint64)
+    with np.errstate(over='ignore'):
+        for column in np.asarray(rows, dtype=np.uint8).T:
+            hashes ^= column
+            hashes *= FNV_PRIME
+    return hashes
+
+
+class SeenSet:
+    """
+    Set of fixed-width uint8 rows (e.g. the encoded passwords generated so far), queried and updated a whole batch at a
+    time. It is an open addressing hash table with linear probing: every slot holds the position of a row in `rows`,
+    and probing goes on only for the queries that have not been resolved yet. Lookups and insertions cost O(1) per row,
+    no matter how many rows are stored.
+    """
+
+    def __init__(self, width, capacity=2 ** 16):
+        self.width = width
+        self.n_rows = 0
+        self.rows = np.zeros((capacity, width), dtype=np.uint8)
+        self.row_hashes = np.zeros(capacity, dtype=np.uint64)
+        self._init_table(2 * capacity)
+
+    def _init_table(self, n_slots):
+        self.mask = np.uint64(n_slots - 1)
+        self.slots = np.full(n_slots, -1, dtype=np.int64)
+
+    def __len__(self):
+        return self.n_rows
+
+    def _probe(self, rows, hashes):
+        # Returns, for each row, its position in self.rows (-1 if absent) and the slot where the probing stopped.
+        positions = np.full(len(rows), -1, dtype=np.int64)
+        slots = (hashes & self.mask).astype(np.int64)
+        pending = np.arange(len(rows))
+
+        while len(pending):
+            stored = self.slots[slots[pending]]
+            empty = stored < 0
+
+            candidates = ~empty
+            candidates[candidates] = self.row_hashes[stored[candidates]] == hashes[pending[candidates]]
+            candidates[candidates] = np.all(self.rows[stored[candidates]] == rows[pending[candidates]], axis=1)
+            positions[pending[candidates]] = stored[candidates]
+
+            pending = pending[~(empty | candidates)]
+            slots[pending] = (slots[pending] + 1) & int(self.mask)
+
+        return positions, slots
+
+    def contains(self, rows):
+        rows = np.asarray(rows, dtype=np.uint8).reshape(-1, self.width)
+        if len(rows) == 0 or self.n_rows == 0:
+            return np.zeros(len(rows), dtype=bool)
+        positions, _ = self._probe(rows, hash_rows(rows))
+        return positions >= 0
+
+    def add(self, rows):
+        """
+        Adds a batch of rows and returns the mask of the rows that were not in the set yet (only the first occurrence
+        of a row repeated in the batch is new).
+        """
+        rows = np.asarray(rows, dtype=np.uint8).reshape(-1, self.width)
+        new = np.zeros(len(rows), dtype=bool)
+        if len(rows) == 0:
+            return new
+
+        self._reserve(self.n_rows + len(rows))
+        hashes = hash_rows(rows)
+        positions, slots = self._probe(rows, hashes)
+
+        # Rows repeated in the batch are inserted once.
+        absent = np.flatnonzero(positions < 0)
+        keys = np.ascontiguousarray(rows[absent]).view(np.dtype((np.void, self.width))).ravel()
+        _, first = np.unique(keys, return_index=True)
+        absent = np.sort(absent[first])
+        new[absent] = True
+
+        start = self.n_rows
+        self.rows[start:start + len(absent)] = rows[absent]
+        self.row_hashes[start:start + len(absent)] = hashes[absent]
+        self.n_rows += len(absent)
+        self._insert(np.arange(start, self.n_rows), slots[absent])
+        return new
+
+    def _insert(self, positions, slots):
+        # Writes the positions into the first empty slot from `slots` on. When several rows reach the same empty slot,
+        # the first one takes it and the others keep probing.
+        while len(positions):
+            free = self.slots[slots] < 0
+            _, first = np.unique(slots, return_index=True)
+            winners = np.zeros(len(positions), dtype=bool)
+            winners[first] = True
+            winners &= free
+
+            self.slots[slots[winners]] = positions[winners]
+            positions, slots = positions[~winners], slots[~winners]
+            slots = (slots + 1) & int(self.mask)
+
+    def _reserve(self, n_rows):
+        if n_rows > len(self.rows):
+            capacity = max(n_rows, 2 * len(self.rows))
+            self.rows = np.concatenate([self.rows, np.zeros((capacity - len(self.rows), self.width), dtype=np.uint8)])
+            self.row_hashes = np.concatenate([self.row_hashes, np.zeros(capacity - len(self.row_hashes), np.uint64)])
+
+        # The load factor is kept below 1/2, so that probing sequences stay short.
+        if 2 * n_rows > len(self.slots):
+            n_slots = len(self.slots)
+            while 2 * n_rows > n_slots:
+                n_slots *= 2
+            self._init_table(n_slots)
+            self._insert(np.arange(self.n_rows), (self.row_hashes[:self.n_rows] & self.mask).astype(np.int64))
+
+    def state_dict(self):
+        return {'rows': self.rows[:self.n_rows].copy()}
+
+    def load_state_dict(self, state):
+        self.__init__(self.width)
+        self.add(state['rows'])
+
+    def clear(self):
+        self.__init__(self.width)
+
+    def close(self):
+        pass
+
+
+class BloomSeenSet:
+    """
+    Same interface as SeenSet, for evaluations generating more rows than fit in memory. Rows are first tested against a
+    Bloom filter, a memory-mapped bit array of about 10 bits per row for a 1% error rate. Only the rows it reports as
+    present are verified exactly, against the most recent rows (an in-memory SeenSet of at most buffer_size rows) and
+    the older ones, stored on disk as sorted runs. A false positive of the filter therefore never drops a new row.
+
+    Files in `path` are kept across instances, so that an evaluation can be resumed: a checkpoint (state_dict) holds the
+    names of the bit array and of the runs, and the rows of the buffer. Run files are never modified once written, runs
+    replaced by a merge are deleted once no checkpoint can reference them anymore. The bit array is only ever set, the
+    bits of the rows added after a checkpoint just make the filter report a few more rows that are then verified. Call
+    clear to start from an empty set.
+    """
+
+    def __init__(self, width, path, expected_rows, error_rate=0.01, buffer_size=2 ** 20, max_run_size=2 ** 26):
+        self.width = width
+        self.path = path
+        self.expected_rows = max(int(expected_rows), 1)
+        self.error_rate = error_rate
+        self.buffer_size = buffer_size
+        self.max_run_size = max_run_size
+
+        n_bits = -self.expected_rows * math.log(error_rate) / math.log(2) ** 2
+        self.n_bits = max(64, 8 * math.ceil(n_bits / 8))
+        self.n_hashes = max(1, round(self.n_bits / self.expected_rows * math.log(2)))
+
+        os.makedirs(path, exist_ok=True)
+        self.bits = self._open_bits('bloom.bits')
+        self.buffer = SeenSet(width)
+        self.runs = []
+        self.n_runs = 0
+        self.n_rows = 0
+        # Runs replaced by a merge since the last state_dict, and before it.
+        self.retired = []
+        self.retired_before = []
+
+    def __len__(self):
+        return self.n_rows
+
+    def _open_bits(self, filename):
+        bits_path = os.path.join(self.path, filename)
+        exists = os.path.isfile(bits_path) and os.path.getsize(bits_path) == self.n_bits // 8
+        return np.memmap(bits_path, dtype=np.uint8, mode='r+' if exists else 'w+', shape=(self.n_bits // 8,))
+
+    def _bit_positions(self, hashes):
+        # Double hashing: the i-th bit of a row is h1 + i * h2, with h2 derived from h1 by a 64 bit finalizer.
+        with np.errstate(over='ignore'):
+            h2 = hashes ^ (hashes >> np.uint64(33))
+            h2 *= np.uint64(0xff51afd7ed558ccd)
+            h2 ^= h2 >> np.uint64(33)
+            h2 |= np.uint64(1)
+            for i in range(self.n_hashes):
+                yield ((hashes + np.uint64(i) * h2) % np.uint64(self.n_bits)).astype(np.int64)
+
+    def _maybe_contains(self, hashes):
+        found = np.ones(len(hashes), dtype=bool)
+        for positions in self._bit_positions(hashes):
+            found &= (self.bits[positions >> 3] >> (positions & 7).astype(np.uint8)) & 1 == 1
+        return found
+
+    def _contains_exact(self, rows):
+        found = self.buffer.contains(rows)
+        keys = as_keys(rows)
+        for run in self.runs:
+            pending = np.flatnonzero(~found)
+            if len(pending) == 0:
+                break
+            positions = np.searchsorted(run, keys[pending])
+            positions[positions == len(run)] = 0
+            found[pending] = run[positions] == keys[pending]
+        return found
+
+    def contains(self, rows):
+        rows = np.asarray(rows, dtype=np.uint8).reshape(-1, self.width)
+        found = self._maybe_contains(hash_rows(rows))
+        candidates = np.flatnonzero(found)
+        found[candidates] = self._contains_exact(rows[candidates])
+        return found
+
+    def add(self, rows):
+        rows = np.asarray(rows, dtype=np.uint8).reshape(-1, self.width)
+        hashes = hash_rows(rows)
+        present = self._maybe_contains(hashes)
+        candidates = np.flatnonzero(present)
+        present[candidates] = self._contains_exact(rows[candidates])
+
+        new = np.zeros(len(rows), dtype=bool)
+        absent = np.flatnonzero(~present)
+        new[absent] = self.buffer.add(rows[absent])
+
+        for positions in self._bit_positions(hashes[new]):
+            np.bitwise_or.at(self.bits, positions >> 3, np.left_shift(1, positions & 7).astype(np.uint8))
+        self.n_rows += int(np.count_nonzero(new))
+
+        if len(self.buffer) >= self.buffer_size:
+            self._spill()
+        return new
+
+    def _spill(self):
+        # The buffer becomes a sorted run, merged with the last runs as long as they are not larger, so that only a
+        # logarithmic number of runs (up to max_run_size rows each) has to be searched.
+        keys = np.sort(as_keys(self.buffer.rows[:len(self.buffer)]))
+        while self.runs and len(self.runs[-1]) <= len(keys) and len(self.runs[-1]) + len(keys) <= self.max_run_size:
+            run = self.runs.pop()
+            keys = np.sort(np.concatenate([np.asarray(run), keys]))
+            self.retired.append(run.filename)
+
+        run_path = os.path.join(self.path, f'run_{self.n_runs}.npy')
+        self.n_runs += 1
+        np.save(run_path, keys)
+        self.runs.append(np.load(run_path, mmap_mode='r'))
+        self.buffer = SeenSet(self.width)
+
+    def state_dict(self):
+        self.bits.flush()
+
+        # The previous checkpoint has been written by now, the runs retired before it are not referenced anymore.
+        for filename in self.retired_before:
+            os.remove(filename)
+        self.retired_before, self.retired = self.retired, []
+
+        return {
+            'bits': os.path.basename(self.bits.filename),
+            'runs': [os.path.basename(run.filename) for run in self.runs],
+            'buffer': self.buffer.state_dict(),
+            'n_runs': self.n_runs,
+            'n_rows': self.n_rows,
+        }
+
+    def load_state_dict(self, state):
+        self.bits = self._open_bits(state['bits'])
+        # Runs written after the checkpoint are not part of it.
+        for filename in set(os.listdir(self.path)) - set(state['runs']) - {state['bits']}:
+            os.remove(os.path.join(self.path, filename))
+
+        self.runs = [np.load(os.path.join(self.path, filename), mmap_mode='r') for filename in state['runs']]
+        self.n_runs = state['n_runs']
+        self.n_rows = state['n_rows']
+        self.buffer = SeenSet(self.width)
+        self.buffer.load_state_dict(state['buffer'])
+        self.retired, self.retired_before = [], []
+
+    def clear(self):
+        self.close()
+        self.__init__(self.width, self.path, self.expected_rows, self.error_rate, self.buffer_size, self.max_run_size)
+
+    def close(self):
+        self.runs = []
+        self.bits = None
+        shutil.rmtree(self.path, ignore_errors=True)
+
+
+def create_seen_set(width, kind='memory', path=None, expected_rows=0, error_rate=0.01):
+    """
+    Returns the set of generated rows used by the models keeping unique guesses: 'memory' for a SeenSet, 'bloom' for a
+    BloomSeenSet storing its files in `path`.
+    """
+    if kind == 'memory':
+        return SeenSet(width)
+    if kind == 'bloom':
+        return BloomSeenSet(width, path, expected_rows, error_rate)
+    raise ValueError(f"Unknown seen set '{kind}', expected 'memory' or 'bloom'.")